@@ -9,6 +9,8 @@ from .projection import *
 from .raster import *
 from .refine_mesh import *
 from .sampling import *
+from .topology import *
+from .variograms import *
 from . import remove_invalid_triangles
 from . import set_case_column_names
 from . import remove_unused_vertices
@@ -2,117 +2,323 @@ import numpy as np
 import pandas as pd
 import scipy.spatial
 import shapely.geometry
+import shapely.prepared
+import shapely.strtree
 import warnings
     
 from . import cleanup
+from . import topology as topology_module
+
+def _edge_keys(edges, labels):
+    """Encode undirected edges (pairs of vertex labels) as int64 keys,
+    ordered like the (min, max) label pairs. labels is either all
+    vertex labels of edges, sorted, or a (min, max) range of integer
+    labels (see _edge_labels())."""
+    if isinstance(labels, tuple):
+        ids = (edges - labels[0]).astype(np.int64)
+        n = labels[1] - labels[0] + 1
+    else:
+        ids = np.searchsorted(labels, edges).astype(np.int64)
+        n = len(labels)
+    return ids.min(axis=1) * n + ids.max(axis=1)
+
+def _edge_labels(*edges):
+    """Vertex labels for _edge_keys() for all of edges: the range of
+    the labels if they are integers in a small enough range, otherwise
+    all labels, sorted."""
+    edges = np.concatenate([e.ravel() for e in edges])
+    if not len(edges):
+        return (0, 0)
+    lo, hi = edges.min(), edges.max()
+    if (edges.dtype.kind in "iu"
+        or (edges.dtype.kind == "f" and np.isfinite([lo, hi]).all() and (edges == np.floor(edges)).all())):
+        if (int(hi) - int(lo) + 1) ** 2 < 2 ** 62:
+            return (int(lo), int(hi))
+    return np.unique(edges)
 
 def mesh_boundary(**tri):
+    """Set tri["segments"] to the edges used by only one triangle, with
+    columns 0 and 1 (the vertices, in increasing order) and triangle
+    (the triangle using the edge), merged with any existing segments.
+    Where an existing segment joins the same vertices as a boundary
+    edge, the boundary edge replaces it.
+
+    If tri has vertices, the edges are taken from its MeshTopology,
+    which is stored in tri["topology"] for reuse. Otherwise, or if
+    the triangles reference vertices missing from the vertex index,
+    the edges are found from the triangle corner labels alone."""
     triangles = tri["triangles"]
 
     if not len(triangles):
         return tri
-    
-    sides = triangles[[0, 1]].assign(triangle=triangles.index).append(
-        triangles[[1, 2]].assign(triangle=triangles.index).rename(columns={1:0, 2:1})).append(
-        triangles[[0, 2]].assign(triangle=triangles.index).rename(columns={2:1})).reset_index(drop=True)
 
-    sides.loc[sides[0] > sides[1], [1, 0]] = sides.loc[sides[0] > sides[1], [0, 1]].rename(columns={0:1, 1:0})
-
-    sides = sides.sort_values([0, 1])
+    corners = triangles[[0, 1, 2]].values
+    topology = None
+    if "vertices" in tri:
+        try:
+            topology = tri["topology"] = topology_module.get_topology(**tri)
+        except KeyError:
+            pass
+    if topology is not None:
+        boundary = topology.boundary_edges
+        edges = tri["vertices"].index.values[topology.edges[boundary]].astype(corners.dtype)
+        edge_triangles = triangles.index.values[topology.edge_triangles[boundary, 0]]
+    else:
+        edges = np.concatenate((corners[:, [0, 1]], corners[:, [1, 2]], corners[:, [0, 2]]))
+        edge_triangles = np.tile(triangles.index.values, 3)
+    existing = tri["segments"][[0, 1]].values if "segments" in tri else np.zeros((0, 2), dtype=edges.dtype)
 
-    segments = sides.drop_duplicates([0, 1], keep=False, ignore_index=True)
+    labels = _edge_labels(edges, existing)
+    keys, first, counts = np.unique(_edge_keys(edges, labels), return_index=True, return_counts=True)
+    single = first[counts == 1]
+    segments = pd.DataFrame({0: edges[single].min(axis=1),
+                             1: edges[single].max(axis=1),
+                             "triangle": edge_triangles[single]})
 
     if "segments" in tri:
-        segments = tri["segments"].append(segments).reset_index().drop(columns=['index'])
-        segments.loc[:, 'vertex_set'] = segments.apply(lambda x: set([x.loc[0], x.loc[1]]), axis=1)
-        segments_unique = segments.vertex_set.astype('str').drop_duplicates(keep='last')
-        segments = segments.loc[segments_unique.index,[0,1,'triangle']]
-        segments = segments.drop_duplicates([0, 1], keep='last', ignore_index=True).reset_index().drop(columns=['index'])
-        
+        segments = pd.concat((tri["segments"], segments), ignore_index=True)
+        # Keep the last of any segments joining the same vertices
+        keys = _edge_keys(np.concatenate((existing, segments[[0, 1]].values[len(existing):])), labels)[::-1]
+        keys, last = np.unique(keys, return_index=True)
+        segments = segments.iloc[np.sort(len(segments) - 1 - last)].reset_index(drop=True)
+        segments = segments.reindex(columns=[0, 1, "triangle"])
+
     tri["segments"] = segments
     
     return tri
 
-def _mesh_boundary_mark_rings(segments):
-    segments = segments.copy()
-    
-    segments["ring"] = np.NaN
-    segments["pos"] = np.NaN
-    ring = 0
+def _coord_columns(vertices, coord_columns=None):
+    """coord_columns, by default X and Y (or x and y if there is no X
+    column), or None if vertices does not have them."""
+    if coord_columns is None:
+        coord_columns = ["X", "Y"] if "X" in vertices.columns else ["x", "y"]
+    if not set(coord_columns).issubset(vertices.columns):
+        return None
+    return list(coord_columns)
 
-    while True:
-        remaining = segments[np.isnan(segments["ring"])]
-        if not len(remaining): break
+def _orient_segments(segments, coord_columns=None, **tri):
+    """Copy of segments where the ends of segments with a triangle are
+    swapped where needed to have the triangle to their left. Segments
+    that are not an edge of their triangle are left as they are."""
+    if "triangle" not in segments.columns or "triangles" not in tri or "vertices" not in tri:
+        return segments
+    vertices = tri["vertices"]
+    triangles = tri["triangles"]
+    coord_columns = _coord_columns(vertices, coord_columns)
+    if coord_columns is None or not triangles.index.is_unique:
+        return segments
 
-        current = remaining.index[0]
+    known = np.flatnonzero(segments["triangle"].notna().values)
+    rows = triangles.index.get_indexer(segments["triangle"].values[known].astype(triangles.index.dtype))
+    known = known[rows >= 0]
+    ends = segments[[0, 1]].values[known]
+    corners = triangles[[0, 1, 2]].values[rows[rows >= 0]]
+    others = (corners != ends[:,:1]) & (corners != ends[:,1:])
+    edge = others.sum(axis=1) == 1
+    known = known[edge]
+    points = vertices.index.get_indexer(
+        np.column_stack((ends[edge], corners[edge][others[edge]])).ravel()).reshape((-1, 3))
+    found = (points >= 0).all(axis=1)
+    known = known[found]
+    xy = vertices[coord_columns].values
+    p0 = xy[points[found,0]]
+    p1 = xy[points[found,1]]
+    c = xy[points[found,2]]
+    flip = np.zeros(len(segments), dtype=bool)
+    flip[known] = (p1[:,0] - p0[:,0]) * (c[:,1] - p0[:,1]) - (p1[:,1] - p0[:,1]) * (c[:,0] - p0[:,0]) < 0
+    segments = segments.copy()
+    segments.loc[flip, [0, 1]] = segments.loc[flip, [1, 0]].values
+    return segments
 
-        ring += 1
-        pos = 0
-        segments.loc[current, "ring"] = ring
-        segments.loc[current, "pos"] = pos
+def _trace_rings(segments, vertices=None, coord_columns=None):
+    """Trace the segments into rings (chains of segments sharing
+    vertices), walking each segment once. Segments may have either
+    orientation, but are followed in their own direction where
+    possible. Chains that do not close are traced from end to end.
 
-        right = segments.loc[current, 1]
+    Where several rings touch at a vertex, and vertices (with the
+    coord_columns, see _coord_columns()) is given, a ring entering the vertex leaves it along the first
+    segment clockwise from the one it came in along, so that rings
+    oriented with the mesh to their left stay separate and do not
+    cross.
 
+    Returns a list of (segment positions, vertex labels) pairs, one per
+    ring, both in the order of the walk. Closed rings do not repeat
+    their first vertex."""
+    ends = segments[[0, 1]].values
+    labels, ids = np.unique(ends, return_inverse=True)
+    ids = ids.reshape(ends.shape)
+    n = len(ids)
 
-        while True:
-            nxt = segments[(segments[0] == right) & (segments.index != current)]
-            prv = segments[(segments[1] == right) & (segments.index != current)]
-            if len(nxt):
-                current = nxt.index[0]
-                right = segments.loc[current, 1]
-            elif len(prv):
-                current = prv.index[0]
-                right = segments.loc[current, 0]
-            else:
-                break
+    # Vertex -> segment adjacency, with the segments starting at a
+    # vertex before the segments ending there, each in segment order
+    vertex = np.concatenate((ids[:,0], ids[:,1]))
+    segment = np.tile(np.arange(n), 2)
+    order = np.lexsort((segment, np.repeat([0, 1], n), vertex))
+    adjacent_segment = segment[order].tolist()
+    adjacent_vertex = np.concatenate((ids[:,1], ids[:,0]))[order].tolist()
+    adjacency_end = np.searchsorted(vertex[order], np.arange(len(labels)), side="right").tolist()
+    cursor = np.searchsorted(vertex[order], np.arange(len(labels))).tolist()
+    outgoing = (order < n).tolist()
+    visited = [False] * n
+    xy = None
+    if vertices is not None:
+        coord_columns = _coord_columns(vertices, coord_columns)
+        points = vertices.index.get_indexer(labels)
+        if coord_columns is not None and (points >= 0).all():
+            xy = vertices[coord_columns].values[points]
 
+    def walk(v, ring_segments, ring_vertices, stop):
+        while v != stop:
+            # Skip past segments already walked, so each adjacency entry
+            # is only looked at once in total
+            while cursor[v] < adjacency_end[v] and visited[adjacent_segment[cursor[v]]]:
+                cursor[v] += 1
+            if cursor[v] == adjacency_end[v]:
+                return False
+            entry = cursor[v]
+            if xy is not None and stop is not None and outgoing[entry]:
+                candidates = [e for e in range(entry, adjacency_end[v])
+                              if outgoing[e] and not visited[adjacent_segment[e]]]
+                if len(candidates) > 1:
+                    back = xy[ring_vertices[-2]] - xy[v]
+                    directions = xy[[adjacent_vertex[e] for e in candidates]] - xy[v]
+                    turns = (np.arctan2(back[1], back[0])
+                             - np.arctan2(directions[:,1], directions[:,0])) % (2 * np.pi)
+                    entry = candidates[np.argmin(np.where(turns > 0, turns, 2 * np.pi))]
+            s = adjacent_segment[entry]
+            v = adjacent_vertex[entry]
+            visited[s] = True
+            ring_segments.append(s)
+            ring_vertices.append(v)
+        return True
 
-            if not np.isnan(segments.loc[current, "ring"]):
-                # Merge an existing ring
-                existing = segments.loc[current, "ring"]
+    rings = []
+    first_vertices = ids[:,0].tolist()
+    last_vertices = ids[:,1].tolist()
+    for s in range(n):
+        if visited[s]:
+            continue
+        visited[s] = True
+        ring_segments = [s]
+        ring_vertices = [first_vertices[s], last_vertices[s]]
+        if walk(last_vertices[s], ring_segments, ring_vertices, first_vertices[s]):
+            ring_vertices.pop()
+        else:
+            before_segments = []
+            before_vertices = []
+            walk(first_vertices[s], before_segments, before_vertices, None)
+            ring_segments = before_segments[::-1] + ring_segments
+            ring_vertices = before_vertices[::-1] + ring_vertices
+        rings.append((np.array(ring_segments), labels[ring_vertices]))
+    return rings
 
-                segments.loc[segments["ring"] == existing, "pos"] += pos
-                segments.loc[segments["ring"] == existing, "ring"] = ring
-                break
+def _mesh_boundary_mark_rings(segments):
+    segments = segments.copy()
+
+    segments["ring"] = np.NaN
+    segments["pos"] = np.NaN
+    for ring, (ring_segments, ring_vertices) in enumerate(_trace_rings(segments)):
+        segments.iloc[ring_segments, segments.columns.get_loc("ring")] = ring + 1
+        segments.iloc[ring_segments, segments.columns.get_loc("pos")] = np.arange(len(ring_segments))
 
-            pos += 1
-            segments.loc[current, "ring"] = ring
-            segments.loc[current, "pos"] = pos
-            
     return segments
 
-def _mesh_boundary_to_pointlists(segments, **tri):
-    segments = _mesh_boundary_mark_rings(segments)
-    
-    res = {}
-    for ring in segments["ring"].unique():
-        ringborders = segments[segments["ring"] == ring]
-    
-        res[int(ring)] = ringborders[[0, "pos"]].rename(columns={0:"point"}).append(
-            ringborders[[1, "pos"]].rename(columns={1:"point"})
-        ).sort_values("pos").drop_duplicates("pos")["point"].values
+def _split_ring(ring):
+    """Split a ring (array of vertex labels) that passes through some
+    vertices more than once into simple rings."""
+    loops = []
+    stack = []
+    position = {}
+    for vertex in ring.tolist():
+        if vertex in position:
+            start = position[vertex]
+            loops.append(stack[start:])
+            for other in stack[start + 1:]:
+                del position[other]
+            del stack[start + 1:]
+        else:
+            position[vertex] = len(stack)
+            stack.append(vertex)
+    loops.append(stack)
+    return [np.array(loop, dtype=ring.dtype) for loop in loops]
 
-    return res
+def _mesh_boundary_to_pointlists(segments, coord_columns=None, **tri):
+    segments = _orient_segments(segments, coord_columns, **tri)
+    rings = []
+    for ring_segments, ring_vertices in _trace_rings(segments, tri.get("vertices", None), coord_columns):
+        if len(np.unique(ring_vertices)) < len(ring_vertices):
+            # Where a hole touches the outside or another hole at a
+            # vertex, the rings pass through it twice
+            rings.extend(_split_ring(ring_vertices))
+        else:
+            rings.append(ring_vertices)
+    return {ring + 1: ring_vertices for ring, ring_vertices in enumerate(rings)}
 
 def mesh_boundary_to_pointlists(segments, **tri):
     warnings.warn("Use mesh_boundary_rings() instead", DeprecationWarning)
     return _mesh_boundary_to_pointlists(segments, **tri)
     
-def mesh_boundary_rings(**tri):
-    tri["rings"] = mesh_boundary_to_pointlists(**tri)
+def mesh_boundary_rings(coord_columns=None, **tri):
+    tri["rings"] = _mesh_boundary_to_pointlists(coord_columns=coord_columns, **tri)
     return tri
     
-def rings_multipolygon(coord_columns=["X", "Y"], **tri):
+def rings_multipolygon(coord_columns=["X", "Y"], holes=True, **tri):
+    """MultiPolygon of the boundary rings of the mesh, computed with
+    mesh_boundary() and mesh_boundary_rings() unless already in tri.
+
+    If holes, rings are classified as shells (counter clockwise) or
+    holes (clockwise) by their signed area, and each hole is added as
+    an interior of the smallest shell containing it. Rings made by
+    mesh_boundary_rings() have the mesh on their left, so this is
+    their orientation. Otherwise each ring becomes a separate polygon.
+    """
     if "rings" not in tri:
         tri = mesh_boundary(**tri)
-        tri = mesh_boundary_rings(**tri)
+        tri = mesh_boundary_rings(coord_columns=coord_columns, **tri)
+    rings = [ring for ring in tri["rings"].values() if len(ring) >= 3]
+    if not rings:
+        return shapely.geometry.MultiPolygon()
+
+    lengths = np.array([len(ring) for ring in rings])
+    starts = np.append(0, np.cumsum(lengths)[:-1])
+    vertices = tri["vertices"]
+    coords = vertices[coord_columns].values[vertices.index.get_indexer(np.concatenate(rings))]
+    ring_coords = np.split(coords, starts[1:])
+    if not holes:
+        return shapely.geometry.MultiPolygon([shapely.geometry.Polygon(c) for c in ring_coords])
+
+    # Signed (shoelace) area of each ring
+    following = np.arange(len(coords)) + 1
+    following[starts + lengths - 1] = starts
+    areas = np.add.reduceat(coords[:,0] * coords[following,1] - coords[following,0] * coords[:,1], starts) / 2
+
+    shell_rings = np.flatnonzero(areas >= 0)
+    shells = [shapely.geometry.Polygon(ring_coords[ring]) for ring in shell_rings]
+    shell_areas = np.abs(areas[shell_rings])
+    tree = shapely.strtree.STRtree(shells)
+    prepared = {}
+    interiors = [[] for shell in shells]
+    for ring in np.flatnonzero(areas < 0):
+        hole = shapely.geometry.Polygon(ring_coords[ring])
+        containing = []
+        for candidate in tree.query(hole):
+            if shell_areas[candidate] < -areas[ring]:
+                continue
+            if candidate not in prepared:
+                prepared[candidate] = shapely.prepared.prep(shells[candidate])
+            if prepared[candidate].covers(hole):
+                containing.append(candidate)
+        if containing:
+            interiors[min(containing, key=lambda shell: shell_areas[shell])].append(ring_coords[ring])
+        else:
+            shells.append(hole)
+            interiors.append([])
+
     return shapely.geometry.MultiPolygon([
-        shapely.geometry.Polygon(
-            shapely.geometry.LineString(
-                tri["vertices"].loc[p][coord_columns].values))
-        for p in tri["rings"].values()])
+        shapely.geometry.Polygon(shell.exterior, shell_interiors)
+        for shell, shell_interiors in zip(shells, interiors)])
 
-    
 def vertices_boundary(**tri):
     segments = pd.DataFrame(
         scipy.spatial.ConvexHull(tri["vertices"][["X", "Y"]]).simplices,
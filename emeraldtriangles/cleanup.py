@@ -1,37 +1,65 @@
 import numpy as np
 import pandas as pd
-
-def clean_triangles(points, faces, decimals = 10, offset=False):
-    points = points.copy()
-    faces = faces.copy()
+import scipy.spatial
+import scipy.sparse
+import scipy.sparse.csgraph
+
+def clean_triangles(points, faces, decimals = 10, offset=False, tolerance=None):
+    """Merge duplicate points, and remove triangles that become
+    degenerate (with two corners at the same point). Points are
+    duplicates if they fall in the same quantization cell (X and Y
+    multiplied by decimals and floored, or their exact coordinates if
+    decimals is None), and if tolerance is given, also if they are
+    within tolerance of each other (found using a KD-tree), so points
+    just across a cell boundary are merged too.
+
+    Each group of duplicates is replaced by the point with the lowest
+    index. Returns points and faces, reindexed to natural indices (see
+    reindex()).
+    """
+    xy = points[["X", "Y"]].values
     if decimals is None:
-        points["Xp"] = points["X"]
-        points["Yp"] = points["Y"]
+        quantized = xy
     else:
-        points["Xp"] = np.floor(points["X"]* decimals + (0.5 if offset else 0))
-        points["Yp"] = np.floor(points["Y"]* decimals + (0.5 if offset else 0))
-
-    index_name = 'index'
-    if points.index.name is not None:
-        index_name = points.index.name
-
-    replacements = points.join(points.reset_index().groupby(["Xp", "Yp"])[index_name].min().rename("new"), on=("Xp", "Yp"))["new"]
-
-    # Merge points that are close to each other
-    faces[0] = replacements.loc[faces[0]].values
-    faces[1] = replacements.loc[faces[1]].values
-    faces[2] = replacements.loc[faces[2]].values
-
-    replacements = replacements.reset_index()
-    keep = replacements[replacements[index_name] == replacements["new"]]
-    
-    points = points.loc[keep["new"]]
-    
-    # Rename so that points has a natural index (no gaps)
-    points, faces = reindex(points, faces)
+        quantized = np.floor(xy * decimals + (0.5 if offset else 0))
+
+    order = np.lexsort((quantized[:,1], quantized[:,0]))
+    new_group = np.ones(len(order), dtype=bool)
+    new_group[1:] = (quantized[order[1:]] != quantized[order[:-1]]).any(axis=1)
+    group = np.empty(len(order), dtype=np.int64)
+    group[order] = np.cumsum(new_group) - 1
+    del quantized, order, new_group
+
+    if tolerance is not None:
+        # Merge groups with any points within tolerance of each other
+        pairs = scipy.spatial.cKDTree(xy).query_pairs(tolerance, output_type="ndarray")
+        n_groups = group.max(initial=-1) + 1
+        graph = scipy.sparse.coo_matrix(
+            (np.ones(len(pairs)), (group[pairs[:,0]], group[pairs[:,1]])), shape=(n_groups, n_groups))
+        n_groups, components = scipy.sparse.csgraph.connected_components(graph, directed=False)
+        group = components[group]
+
+    # The representative of each group is its point with the lowest index
+    rank = np.empty(len(group), dtype=np.int64)
+    rank[np.argsort(points.index.values, kind="stable")] = np.arange(len(group))
+    order = np.lexsort((rank, group))
+    representative = order[np.flatnonzero(np.diff(group[order], prepend=-1) != 0)][group]
+    keep = representative == np.arange(len(group))
+    new_position = np.cumsum(keep) - 1
+
+    # Merge points that are close to each other, and rename so that
+    # points has a natural index (no gaps)
+    corners = points.index.get_indexer(faces[[0, 1, 2]].values.ravel())
+    if (corners < 0).any():
+        missing = np.unique(faces[[0, 1, 2]].values.ravel()[corners < 0])
+        raise KeyError("%s not in index" % (list(missing),))
+    corners = new_position[representative[corners]].reshape((-1, 3))
+    faces = faces.reset_index(drop=True)
+    faces[0] = corners[:,0]
+    faces[1] = corners[:,1]
+    faces[2] = corners[:,2]
+    points = points.iloc[keep].reset_index(drop=True).rename_axis(index=points.index.name)
 
-    points = points.drop(columns=["Xp", "Yp"])
-    
     # Remove z-size triangles
     faces = faces[(faces[0] != faces[1]) & (faces[0] != faces[2]) & (faces[1] != faces[2])]
     
@@ -1,19 +1,82 @@
 #import scipy.spatial.distance
 # from scipy.sparse import csr_array
 from scipy.spatial import cKDTree
-#import numpy as np
+import scipy.sparse
+import scipy.sparse.csgraph
+import numpy as np
+
+from . import topology as topology_module
+
+def _edge_graph(x_col="X", y_col="Y", **tri):
+    """Sparse symmetric graph of the triangle edges of tri, weighted by
+    edge length, over the vertices in the order of tri["vertices"]"""
+    vertices = tri["vertices"]
+    edges = topology_module.get_topology(**tri).edges
+    xy = vertices[[x_col, y_col]].values
+    lengths = np.linalg.norm(xy[edges[:,0]] - xy[edges[:,1]], axis=1)
+    return scipy.sparse.coo_matrix(
+        (lengths, (edges[:,0], edges[:,1])),
+        shape=(len(vertices), len(vertices))).tocsr()
+
+def distances_to_data(cols, x_col="X", y_col="Y", distance_upper_bound=None, method="euclidean", workers=-1, **tri):
+    """Calculate the distance to vertices with non-NaN values for each
+    of the columns cols and store the distance in the columns
+    col_dist. Columns with the same vertices with non-NaN values share
+    the computation.
+
+    Parameters
+    -----------
+    cols : list of str
+      Columns to calculate distances for.
+    distance_upper_bound : float
+      Only search this far for data. Vertices further away get a
+      distance of inf.
+    method : str
+      "euclidean" for spatial distance (cartesian distance in the
+      current projection), or "geodesic" for the shortest distance
+      along the triangle edges of the mesh. Vertices not connected to
+      any data get a distance of inf.
+    workers : int
+      Number of threads for KD-tree queries (-1 for one per cpu).
+    """
+    vertices = tri["vertices"]
+    if method == "geodesic":
+        graph = _edge_graph(x_col, y_col, **tri)
+    elif method != "euclidean":
+        raise NotImplementedError("Unknown distance method %s..." % (method,))
+
+    filts = vertices[list(cols)].notna().values
+    groups = {}
+    for idx, col in enumerate(cols):
+        groups.setdefault(np.packbits(filts[:,idx]).tobytes(), []).append(col)
+
+    for group in groups.values():
+        filt = vertices[group[0]].notna().values
+        if not filt.any():
+            continue
+        if method == "geodesic":
+            dist = scipy.sparse.csgraph.dijkstra(
+                graph, directed=False, indices=np.flatnonzero(filt), min_only=True,
+                limit=np.inf if distance_upper_bound is None else distance_upper_bound)
+        else:
+            xy = vertices[[x_col, y_col]].values
+            dist = np.zeros(len(vertices))
+            dist[~filt], i = cKDTree(xy[filt]).query(
+                xy[~filt],
+                distance_upper_bound=np.inf if distance_upper_bound is None else distance_upper_bound,
+                workers=workers)
+        for col in group:
+            vertices['%s_dist' % col] = dist
+
+    return tri
 
 def distance_to_data(col, x_col="X", y_col="Y", **tri):
     """Calculate spatial distance (cartesian distance in the current
     projection) to vertices with non-NaN values in the column col and
     store the distance in the column col_dist.
-    """
-    filt = ~tri["vertices"][col].isna()
-    XA = tri["vertices"].loc[~filt][[x_col,y_col]].values
-    XB = tri["vertices"].loc[filt][[x_col,y_col]].values
-    if len(XB):
-        tri["vertices"].loc[filt,'%s_dist' % col] = 0.0
-        d, i = cKDTree(XB).query(XA)
-        tri["vertices"].loc[~filt,'%s_dist' % col] = d
 
-    return tri
+    See distances_to_data() for distance_upper_bound, method and
+    workers, which can be given as extra arguments.
+    """
+    kw = {key: tri.pop(key) for key in ("distance_upper_bound", "method", "workers") if key in tri}
+    return distances_to_data([col], x_col, y_col, **kw, **tri)
@@ -1,15 +1,24 @@
 import numpy as np
 import skgstat
 import logging
-from .points_in_mesh import points_in_triangles
+import json
+from .points_in_mesh import get_locator
+from .sampling import sample_arrays
 import scipy.interpolate
+import scipy.spatial
+import scipy.sparse
+import scipy.sparse.csgraph
+import scipy.sparse.linalg
 from copy import deepcopy
+from . import parallel
+from . import variograms as variograms_module
+from . import topology as topology_module
 
 logger = logging.getLogger(__name__)
 
 
 
-def interpolate_arrays(param_name, variograms, positions, values, new_positions, variogram_args={}, kriging_args={}):
+def interpolate_arrays(param_name, variograms, positions, values, new_positions, variogram_args={}, kriging_args={}, variogram_cache=None, triangles=None):
     """Helper function for interpolate() that generates, stores and
     uses variograms the same way, but uses data from explicitly
     supplied arrays for both generating the variogram and for kriging.
@@ -34,6 +43,15 @@ def interpolate_arrays(param_name, variograms, positions, values, new_positions,
       Extra arguments to skgstat.Variogram
     kriging_args : dict
       Extra arguments to skgstat.OrdinaryKriging
+    variogram_cache : VariogramCache
+      Cache to look up and store fitted variograms in, optional
+    triangles : np.ndarray[T,3]
+      Mesh triangles, as indices into positions followed by
+      new_positions. Required by the "mesh" method.
+
+    kriging_args["method"] selects the interpolation method, one of
+    "kriging" (default), "local_kriging", "linear", "cubic", "spline",
+    "idw" (see idw_arrays()) and "mesh" (see mesh_interpolation_arrays()).
     """
     kriging_args_copy = deepcopy(kriging_args)
     method = kriging_args_copy.pop("method", "kriging")
@@ -45,7 +63,9 @@ def interpolate_arrays(param_name, variograms, positions, values, new_positions,
         return np.full(len(new_positions), np.nanmax(values)), np.full(len(new_positions), 0)
 
     if method == "kriging":
-        return interpolate_arrays_kriging(param_name, variograms, positions, values, new_positions, variogram_args, kriging_args_copy)
+        return interpolate_arrays_kriging(param_name, variograms, positions, values, new_positions, variogram_args, kriging_args_copy, variogram_cache)
+    elif method == "local_kriging":
+        return interpolate_arrays_local_kriging(param_name, variograms, positions, values, new_positions, variogram_args, kriging_args_copy, variogram_cache)
     elif method == "linear":
         res = scipy.interpolate.griddata(positions, values, new_positions)
         # Placeholder variance of np.nan everywhere
@@ -54,6 +74,14 @@ def interpolate_arrays(param_name, variograms, positions, values, new_positions,
         res = scipy.interpolate.griddata(positions, values, new_positions, method="cubic")
         # Placeholder variance of np.nan everywhere
         return res, res * np.nan
+    elif method == "idw":
+        res = idw_arrays(positions, values[:,None], new_positions, **kriging_args_copy)[:,0]
+        # Placeholder variance of np.nan everywhere
+        return res, res * np.nan
+    elif method == "mesh":
+        res = mesh_interpolation_arrays(positions, values[:,None], new_positions, triangles)[:,0]
+        # Placeholder variance of np.nan everywhere
+        return res, res * np.nan
     elif method == "spline":
         res = scipy.interpolate.SmoothBivariateSpline(
             positions[:,0], positions[:,1], values, s=0
@@ -64,17 +92,137 @@ def interpolate_arrays(param_name, variograms, positions, values, new_positions,
     else:
         raise NotImplementedError("Unknown interpolation method %s..." % (method,))
 
- 
-def interpolate_arrays_kriging(param_name, variograms, positions, values, new_positions, variogram_args={}, kriging_args={}):
-    if param_name not in variograms.index:
+
+def idw_arrays(positions, values, new_positions, n_neighbours=8, radius=None, power=2, workers=-1):
+    """Inverse distance weighted interpolation from the nearest
+    conditioning points, found using a KD-tree.
+
+    Parameters
+    -----------
+    positions : np.ndarray[N,2]
+      Positions of the conditioning data.
+    values : np.ndarray[N, n_cols]
+      Conditioning data.
+    new_positions : np.ndarray[M,2]
+      Positions to interpolate values to.
+    n_neighbours : int
+      Maximum number of conditioning points to use per position.
+    radius : float
+      Only use conditioning points within this distance. Positions
+      without any get NaN.
+    power : float
+      Weights are distance ** -power.
+    workers : int
+      Number of threads for the KD-tree queries (-1 for one per cpu).
+
+    Returns np.ndarray[M, n_cols].
+    """
+    n_neighbours = min(n_neighbours, len(positions))
+    dist, idx = scipy.spatial.cKDTree(positions).query(
+        new_positions, n_neighbours,
+        distance_upper_bound=np.inf if radius is None else radius,
+        workers=workers)
+    dist = dist.reshape((len(new_positions), n_neighbours))
+    idx = idx.reshape((len(new_positions), n_neighbours))
+
+    found = np.isfinite(dist)
+    idx[~found] = 0
+    exact = found & (dist == 0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        weights = np.where(found, 1 / dist ** power, 0)
+        # Positions on top of conditioning points take their values
+        weights[exact.any(axis=1)] = exact[exact.any(axis=1)]
+        return np.einsum("ij,ijc->ic", weights, values[idx]) / weights.sum(axis=1)[:,None]
+
+def mesh_interpolation_arrays(positions, values, new_positions, triangles):
+    """Interpolation over the edges of an existing mesh, without
+    retriangulating: new positions get the harmonic interpolation of
+    the conditioning data, that is, each new position gets the average
+    of its neighbours along mesh edges weighted by inverse edge length.
+    This is solved as one sparse linear system for all columns.
+
+    Parameters
+    -----------
+    positions : np.ndarray[N,2]
+      Positions of the conditioning data.
+    values : np.ndarray[N, n_cols]
+      Conditioning data.
+    new_positions : np.ndarray[M,2]
+      Positions to interpolate values to.
+    triangles : np.ndarray[T,3]
+      Mesh triangles, as indices into positions followed by
+      new_positions.
+
+    Returns np.ndarray[M, n_cols]. New positions not connected to any
+    conditioning point get NaN.
+    """
+    if triangles is None:
+        raise ValueError("The mesh interpolation method requires triangles")
+    n = len(positions)
+    all_positions = np.concatenate((positions, new_positions))
+    edges = np.sort(np.asarray(triangles)[:, [0, 1, 1, 2, 2, 0]].reshape((-1, 2)), axis=1)
+    edges = np.unique(edges, axis=0)
+    lengths = np.linalg.norm(all_positions[edges[:,0]] - all_positions[edges[:,1]], axis=1)
+    weights = 1 / np.maximum(lengths, np.finfo(float).tiny)
+    adjacency = scipy.sparse.coo_matrix(
+        (np.concatenate((weights, weights)),
+         (np.concatenate((edges[:,0], edges[:,1])), np.concatenate((edges[:,1], edges[:,0])))),
+        shape=(len(all_positions), len(all_positions))).tocsr()
+
+    # Only new positions connected to some conditioning point can be
+    # solved for
+    n_components, labels = scipy.sparse.csgraph.connected_components(adjacency, directed=False)
+    solvable = np.isin(labels[n:], labels[:n])
+    unknown = n + np.flatnonzero(solvable)
+
+    res = np.full((len(new_positions), values.shape[1]), np.nan)
+    if not len(unknown):
+        return res
+    laplacian = (scipy.sparse.diags(np.asarray(adjacency[unknown].sum(axis=1)).ravel())
+                 - adjacency[unknown][:, unknown])
+    rhs = adjacency[unknown][:, :n] @ values
+    res[solvable] = scipy.sparse.linalg.splu(laplacian.tocsc()).solve(rhs)
+    return res
+
+def get_variogram(param_name, variograms, positions, values, variogram_args={}, variogram_cache=None):
+    """Return the variogram for param_name from variograms, or generate
+    it from positions and values and store it in variograms. Returns
+    either a skgstat.Variogram (if generated) or a variogram
+    description (dict).
+
+    If a VariogramCache is given, it is checked before generating a
+    new variogram, and new variograms are added to it.
+
+    If variogram_args contains "estimation": "kdtree", the variogram
+    is estimated with estimate_variogram() (for large numbers of
+    positions), with the remaining variogram_args as arguments, and a
+    description is returned."""
+    if param_name in variograms.index:
+        return variograms.loc[param_name, "variogram"]["values"]
+
+    variogram = None
+    if variogram_cache is not None:
+        key = variograms_module.variogram_fingerprint(param_name, positions, values, variogram_args)
+        variogram = variogram_cache.get(key)
+    if variogram is None:
         logger.debug(f"...Generating variogram for  {param_name}...")
-        variogram = skgstat.Variogram(positions, values, **variogram_args)
-        desc = variogram.describe()
-        desc["experimental"] = list(variogram.experimental)
-        desc["bins"] = list(variogram.bins)        
-        variograms.loc[param_name] = {"variogram": {"type": "skgstat.Variogram", "values": desc}}
+        if variogram_args.get("estimation", None) == "kdtree":
+            variogram = variograms_module.estimate_variogram(
+                positions, values,
+                **{key: value for key, value in variogram_args.items() if key != "estimation"})
+        else:
+            variogram = skgstat.Variogram(positions, values, **variogram_args)
+        if variogram_cache is not None:
+            variogram_cache.set(key, variogram)
     else:
-        variogram = variograms.loc[param_name, "variogram"]["values"]
+        logger.debug(f"...Using cached variogram for  {param_name}...")
+    variograms.loc[param_name] = {"variogram": {
+        "type": "skgstat.Variogram",
+        "values": variograms_module.variogram_description(variogram)}}
+    return variogram
+
+def interpolate_arrays_kriging(param_name, variograms, positions, values, new_positions, variogram_args={}, kriging_args={}, variogram_cache=None):
+    variogram = get_variogram(param_name, variograms, positions, values, variogram_args, variogram_cache)
         
     kriging = skgstat.OrdinaryKriging(
         variogram,
@@ -86,7 +234,176 @@ def interpolate_arrays_kriging(param_name, variograms, positions, values, new_po
     variance = kriging.sigma
     return values, variance
 
-def interpolate(col, variograms, variogram_args={}, kriging_args={}, **tri):
+class _ColumnsOrdinaryKriging(skgstat.OrdinaryKriging):
+    """skgstat.OrdinaryKriging of several columns of values,
+    np.ndarray[N, n_cols], at once. The kriging weights do not depend
+    on the values, so each kriging system is solved once for all
+    columns. transform() returns the first column, and stores all
+    columns in column_z."""
+    def transform(self, *x):
+        self.column_z = np.full((len(x[0]), self.values.shape[1]), np.nan)
+        return super().transform(*x)
+
+    def _krige(self, idx):
+        z, sigma = super()._krige(idx)
+        self.column_z[idx] = z
+        return z[0], sigma
+
+def _local_kriging_chunk(shared, batch_targets):
+    """Ordinary kriging of the targets in each batch (row of
+    batch_targets, padded with -1) from the n_neighbours conditioning
+    points closest to the batch centroid. The neighbourhoods and
+    distances are shared by all variograms, and the kriging systems of
+    all batches are solved as one stack per variogram, with one right
+    hand side per target, for all columns using that variogram."""
+    tree, values, new_positions, variograms, column_variograms, n_neighbours = shared
+
+    used = batch_targets >= 0
+    targets = new_positions[np.where(used, batch_targets, 0)]
+    centroids = (targets * used[:,:,None]).sum(axis=1) / used.sum(axis=1)[:,None]
+    dist, neighbours = tree.query(centroids, n_neighbours)
+    neighbours = neighbours.reshape((len(batch_targets), n_neighbours))
+    coords = tree.data[neighbours]
+    neighbour_dists = np.linalg.norm(coords[:,:,None,:] - coords[:,None,:,:], axis=-1)
+    target_dists = np.linalg.norm(coords[:,:,None,:] - targets[:,None,:,:], axis=-1)
+    neighbour_values = values[neighbours]
+
+    n_batches = len(batch_targets)
+    z = np.empty((n_batches, batch_targets.shape[1], values.shape[1]))
+    sigma = np.empty((n_batches, batch_targets.shape[1], values.shape[1]))
+    for idx, variogram in enumerate(variograms):
+        model = skgstat.Variogram.fitted_model_function(**variogram)
+        def gamma(dist):
+            # skgstat models only take 1d arrays
+            return model(dist.ravel()).reshape(dist.shape)
+
+        a = np.ones((n_batches, n_neighbours + 1, n_neighbours + 1))
+        a[:, :-1, :-1] = gamma(neighbour_dists)
+        a[:, -1, -1] = 0
+
+        b = np.ones((n_batches, n_neighbours + 1, batch_targets.shape[1]))
+        b[:, :-1, :] = gamma(target_dists)
+
+        weights = np.linalg.solve(a, b)
+
+        cols = column_variograms == idx
+        z[:,:,cols] = np.einsum("ijk,ijc->ikc", weights[:, :-1, :], neighbour_values[:,:,cols])
+        sigma[:,:,cols] = ((weights[:, :-1, :] * b[:, :-1, :]).sum(axis=1) + weights[:, -1, :])[:,:,None]
+    return z[used], sigma[used]
+
+def local_kriging_arrays(positions, values, new_positions, variograms, column_variograms=None, n_neighbours=32, batch_size=8, chunk_size=1024, workers=None):
+    """Ordinary kriging using a moving neighbourhood, for large numbers
+    of conditioning points. Targets are grouped into batches of nearby
+    targets, and each batch is kriged from the n_neighbours
+    conditioning points closest to its centroid, found using a KD-tree,
+    so that all targets of a batch share one small kriging system.
+
+    Several columns of values, sharing the same positions, can be
+    kriged at once. They share the neighbourhood search, and columns
+    using the same variogram share the kriging systems too.
+
+    Parameters
+    -----------
+    positions : np.ndarray[N,2]
+      Positions of the conditioning data.
+    values : np.ndarray[N, n_cols]
+      Conditioning data.
+    new_positions : np.ndarray[M,2]
+      Positions to krige values to.
+    variograms : list of dict
+      Variogram descriptions.
+    column_variograms : np.ndarray[n_cols]
+      Index into variograms of the variogram of each column. By
+      default, all columns use the first variogram.
+    n_neighbours : int
+      Number of conditioning points per neighbourhood.
+    batch_size : int
+      Maximum number of targets sharing a neighbourhood, taken from the
+      same cell of a grid sized to hold about batch_size targets per
+      cell. Use 1 for a separate neighbourhood for each target.
+    chunk_size : int
+      Number of batches solved together as one stack.
+    workers : int
+      Number of worker processes (-1 for one per cpu) to split the
+      chunks between.
+
+    Returns values and variance, both np.ndarray[M, n_cols].
+    """
+    if column_variograms is None:
+        column_variograms = np.zeros(values.shape[1], dtype=int)
+    res = np.full((len(new_positions), values.shape[1]), np.nan)
+    variance = np.full((len(new_positions), values.shape[1]), np.nan)
+
+    # Duplicated positions would make the kriging systems singular
+    positions, inverse = np.unique(positions, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    counts = np.bincount(inverse)
+    values = np.column_stack([np.bincount(inverse, column) / counts for column in values.T])
+    n_neighbours = min(n_neighbours, len(positions))
+    if not len(new_positions):
+        return res, variance
+
+    # Batches are groups of at most batch_size targets within the same
+    # grid cell, with cells sized to hold about batch_size targets
+    lo = new_positions.min(axis=0)
+    extent = new_positions.max(axis=0) - lo
+    cell_size = np.sqrt(max(extent[0] * extent[1], extent.max() ** 2 / len(new_positions), 1e-12)
+                        * batch_size / len(new_positions))
+    cells = np.floor((new_positions - lo) / cell_size).astype(np.int64)
+    cells = cells[:,1] * (cells[:,0].max() + 1) + cells[:,0]
+    order = np.argsort(cells, kind="stable")
+    cells = cells[order]
+    cell_start = np.flatnonzero(np.diff(cells, prepend=-1))
+    pos_in_cell = np.arange(len(cells)) - np.repeat(cell_start, np.diff(np.append(cell_start, len(cells))))
+    batch = np.cumsum((pos_in_cell % batch_size) == 0) - 1
+    n_batches = batch[-1] + 1 if len(batch) else 0
+    batches = np.full((n_batches, batch_size), -1)
+    batches[batch, pos_in_cell % batch_size] = order
+
+    variograms = [{key: value for key, value in variogram.items() if key not in ("experimental", "bins")}
+                  for variogram in variograms]
+    shared = (scipy.spatial.cKDTree(positions), values, new_positions,
+              variograms, np.asarray(column_variograms), n_neighbours)
+    chunks = [(batches[start:start + chunk_size],) for start in range(0, n_batches, chunk_size)]
+    results = parallel.map_shared(_local_kriging_chunk, shared, chunks, workers)
+
+    if results:
+        targets = np.concatenate([chunk[chunk >= 0] for chunk, in chunks])
+        res[targets] = np.concatenate([z for z, sigma in results])
+        variance[targets] = np.concatenate([sigma for z, sigma in results])
+    return res, variance
+
+def interpolate_arrays_local_kriging(param_name, variograms, positions, values, new_positions, variogram_args={}, kriging_args={}, variogram_cache=None):
+    """Ordinary kriging using a moving neighbourhood, see
+    local_kriging_arrays(). The variogram is generated and stored the
+    same way as for interpolate_arrays_kriging().
+
+    kriging_args can contain n_neighbours (default 32), batch_size
+    (default 8), chunk_size (default 1024) and workers, see
+    local_kriging_arrays().
+    """
+    variogram = variograms_module.variogram_description(
+        get_variogram(param_name, variograms, positions, values, variogram_args, variogram_cache))
+    res, variance = local_kriging_arrays(
+        positions, values[:,None], new_positions, [variogram],
+        **{key: value for key, value in kriging_args.items()
+           if key in ("n_neighbours", "batch_size", "chunk_size", "workers")})
+    return res[:,0], variance[:,0]
+
+def _mesh_triangles(existing, kriging_args, **tri):
+    """Triangles of tri as indices into the vertices with existing
+    values followed by the vertices without, as used by
+    interpolate_arrays(). Only needed (and computed) for the "mesh"
+    method."""
+    if kriging_args.get("method") != "mesh" or "triangles" not in tri:
+        return None
+    existing = np.asarray(existing)
+    order = np.concatenate((np.flatnonzero(existing), np.flatnonzero(~existing)))
+    rank = np.empty(len(order), dtype=int)
+    rank[order] = np.arange(len(order))
+    return rank[topology_module.get_topology(**tri).faces]
+
+def interpolate(col, variograms, variogram_args={}, kriging_args={}, variogram_cache=None, **tri):
     """Interpolate vertice column data using scikit-gstat. Data is
     interpolated from rows with non-NaN values to rows with NaN
     values.
@@ -105,9 +422,13 @@ def interpolate(col, variograms, variogram_args={}, kriging_args={}, **tri):
       Extra arguments to skgstat.Variogram
     kriging_args : dict
       Extra arguments to skgstat.OrdinaryKriging
+    variogram_cache : VariogramCache
+      Cache to look up and store fitted variograms in, optional
     **tri
       Triangulation to interpolate data over
     """
+    if kriging_args.get("method") == "mesh" and "triangles" in tri:
+        tri = topology_module.mesh_topology(**tri)
     vertices = tri["vertices"]
 
     existing = ~np.isnan(vertices[col])
@@ -123,7 +444,9 @@ def interpolate(col, variograms, variogram_args={}, kriging_args={}, **tri):
             vertices.loc[existing, col].values,
             vertices.loc[~existing, ["X", "Y"]].values,
             variogram_args,
-            kriging_args)
+            kriging_args,
+            variogram_cache,
+            _mesh_triangles(existing, kriging_args, **tri))
 
         vertices.loc[~existing, col] = values
         vertices.loc[~existing, col + '_kriging_uncertainty'] = variance
@@ -137,6 +460,153 @@ def interpolate(col, variograms, variogram_args={}, kriging_args={}, **tri):
     return tri
 
 
+def _column_variograms(param_names, cols, variograms, positions, values, variogram_args={}, variogram_cache=None):
+    """Variograms (see get_variogram()) of the columns cols of values,
+    with columns with identical variogram descriptions sharing one.
+    Returns the list of distinct variograms, and the index into it of
+    the variogram of each column."""
+    distinct = {}
+    column_variograms = []
+    for idx in cols:
+        variogram = get_variogram(param_names[idx], variograms, positions, values[:,idx], variogram_args, variogram_cache)
+        description = variograms_module.variogram_description(variogram)
+        key = json.dumps({key: value for key, value in description.items() if key not in ("experimental", "bins")},
+                         sort_keys=True, default=variograms_module._json_default)
+        column_variograms.append(distinct.setdefault(key, (len(distinct), variogram))[0])
+    return [variogram for idx, variogram in distinct.values()], np.array(column_variograms, dtype=int)
+
+def interpolate_arrays_columns(param_names, variograms, positions, values, new_positions, variogram_args={}, kriging_args={}, variogram_cache=None, triangles=None):
+    """Like interpolate_arrays(), but for several columns of values
+    sharing the same positions and new_positions. Returns values and
+    variance, both np.ndarray[M, n_cols].
+
+    Linear and cubic interpolation triangulate the positions once for
+    all columns, IDW searches neighbours once for all columns, and mesh
+    interpolation solves its system once for all columns. Kriging and
+    local kriging solve each kriging system once for all columns with
+    identical variograms (local kriging also searches neighbourhoods
+    once for all columns). Spline interpolation, and kriging with
+    n_jobs > 1, interpolate the columns one by one.
+
+    Parameters
+    -----------
+
+    param_names : list of str
+      Names of variograms to use, one per column of values
+    values : np.ndarray[N, n_cols]
+      Values to interpolate
+
+    See interpolate_arrays() for the other parameters.
+    """
+    kriging_args_copy = deepcopy(kriging_args)
+    method = kriging_args_copy.pop("method", "kriging")
+
+    res = np.full((len(new_positions), len(param_names)), np.nan)
+    variance = np.full((len(new_positions), len(param_names)), np.nan)
+
+    # Columns with nothing to interpolate are handled by
+    # interpolate_arrays() like for single columns, as are all columns
+    # for methods that can not share work between columns
+    separate = np.isnan(values).all(axis=0)
+    separate[~separate] = np.nanmin(values[:,~separate], axis=0) == np.nanmax(values[:,~separate], axis=0)
+    if method not in ("linear", "cubic", "idw", "mesh", "kriging", "local_kriging"):
+        separate[:] = True
+    elif method == "kriging" and kriging_args_copy.get("n_jobs", 1) not in (None, 1):
+        # skgstat's multiprocessing kriging only handles single columns
+        separate[:] = True
+    for idx in np.flatnonzero(separate):
+        res[:,idx], variance[:,idx] = interpolate_arrays(
+            param_names[idx], variograms, positions, values[:,idx], new_positions,
+            variogram_args, kriging_args, variogram_cache, triangles)
+    cols = np.flatnonzero(~separate)
+    if not len(cols):
+        return res, variance
+    logger.debug("Interpolating %s using %s..." % (", ".join(param_names[idx] for idx in cols), method))
+
+    if method in ("linear", "cubic"):
+        res[:,cols] = scipy.interpolate.griddata(positions, values[:,cols], new_positions, method=method)
+    elif method == "idw":
+        res[:,cols] = idw_arrays(positions, values[:,cols], new_positions, **kriging_args_copy)
+    elif method == "mesh":
+        res[:,cols] = mesh_interpolation_arrays(positions, values[:,cols], new_positions, triangles)
+    elif method == "kriging":
+        distinct, column_variograms = _column_variograms(
+            param_names, cols, variograms, positions, values, variogram_args, variogram_cache)
+        for idx, variogram in enumerate(distinct):
+            group = cols[column_variograms == idx]
+            kriging = _ColumnsOrdinaryKriging(
+                variogram,
+                coordinates=positions,
+                values=values[:,group],
+                **kriging_args_copy)
+            kriging.transform(new_positions[:,0], new_positions[:,1])
+            res[:,group] = kriging.column_z
+            variance[:,group] = kriging.sigma[:,None]
+    elif method == "local_kriging":
+        distinct, column_variograms = _column_variograms(
+            param_names, cols, variograms, positions, values, variogram_args, variogram_cache)
+        res[:,cols], variance[:,cols] = local_kriging_arrays(
+            positions, values[:,cols], new_positions,
+            [variograms_module.variogram_description(variogram) for variogram in distinct],
+            column_variograms,
+            **{key: value for key, value in kriging_args_copy.items()
+               if key in ("n_neighbours", "batch_size", "chunk_size", "workers")})
+    return res, variance
+
+def interpolate_columns(cols, variograms, variogram_args={}, kriging_args={}, variogram_cache=None, **tri):
+    """Interpolate several vertice columns, like calling interpolate()
+    for each of them, but interpolating all columns with the same
+    vertices missing values together, see
+    interpolate_arrays_columns().
+
+    Parameters
+    -----------
+
+    cols : list of str
+      Names of columns to interpolate
+
+    See interpolate() for the other parameters.
+    """
+    if kriging_args.get("method") == "mesh" and "triangles" in tri:
+        tri = topology_module.mesh_topology(**tri)
+    vertices = tri["vertices"]
+
+    missing = np.isnan(vertices[list(cols)].values)
+    groups = {}
+    for idx, col in enumerate(cols):
+        groups.setdefault(np.packbits(missing[:,idx]).tobytes(), []).append(col)
+
+    for group in groups.values():
+        existing = ~np.isnan(vertices[group[0]].values)
+        if existing.sum() == 0 or (~existing).sum() == 0:
+            continue
+
+        if "variogram" not in variograms.columns:
+            variograms["variogram"] = None
+
+        values, variance = interpolate_arrays_columns(
+            group,
+            variograms,
+            vertices.loc[existing, ["X", "Y"]].values,
+            vertices.loc[existing, group].values,
+            vertices.loc[~existing, ["X", "Y"]].values,
+            variogram_args,
+            kriging_args,
+            variogram_cache,
+            _mesh_triangles(existing, kriging_args, **tri))
+
+        vertices.loc[~existing, group] = values
+        vertices.loc[~existing, [col + '_kriging_uncertainty' for col in group]] = variance
+
+        if "meta" not in tri: tri["meta"] = {}
+        if "columns" not in tri["meta"]: tri["meta"]["columns"] = {}
+        for col in group:
+            if col not in tri["meta"]["columns"]: tri["meta"]["columns"][col] = {}
+            tri["meta"]["columns"][col].update({"variogram": variogram_args, "kriging": kriging_args})
+
+    return tri
+
+
 def barycentric_interpolation(xt,yt,zt, triangles, xp,yp):
 
     X_tri = xt[triangles]
@@ -162,47 +632,42 @@ def barycentric_interpolation(xt,yt,zt, triangles, xp,yp):
     Pz = wv1 * Z_tri[:, 1] + wv2 * Z_tri[:, 2] + wv3 * Z_tri[:, 0]
     return Pz
 
-def sample_from_triangulation(col, col_output = None, **tri):
+def sample_from_triangulation(col, col_output = None, workers = None, **tri):
     """Interpolate vertices column data using barycentric interpolation.
     In other words, sample values from the existing triangles at points locations.
 
     Point not overlapping with the triangles get set to 0
 
+    The MeshLocator of the triangulation is stored in tri["locator"]
+    and reused on subsequent calls with the returned triangulation.
+
     Parameters
     -----------
 
-    col : str
-      Name of column on vertices to interpolate
-    col_output : str
+    col : str or list of str
+      Name of column on vertices to interpolate, or list of names to
+      interpolate several columns in one pass
+    col_output : str or list of str
       Name of column on points where output will be stored. By default, set to same as col
+    workers : int
+      Number of worker processes (-1 for one per cpu) to split the points between
     **tri
       Triangulation to interpolate data over
     """
 
     if col_output is None:
         col_output = col
+    if isinstance(col, str):
+        col, col_output = [col], [col_output]
 
-    points_and_triangles = points_in_triangles(**tri)
-
-    mask_points_overlap = points_and_triangles["triangle"] != -1
-
-    points_masked = tri['points'].iloc[points_and_triangles.loc[mask_points_overlap, 'point']]
-    points_and_triangles_masked = points_and_triangles[mask_points_overlap]
-
-
-    tri_vert = tri['triangles'].iloc[points_and_triangles_masked.triangle.values, :]
-    tri_vert_np = tri_vert.loc[:, [0, 1, 2]].values
-
-    xt = tri['vertices'].X.values
-    yt = tri['vertices'].Y.values
-    zt = tri['vertices'].loc[:, col].values
-
-    xp = points_masked.X.values
-    yp = points_masked.Y.values
-
-    zp = barycentric_interpolation(xt, yt, zt, tri_vert_np, xp, yp)
+    tri["locator"] = get_locator(**tri)
 
-    tri['points'].loc[points_masked.index, col_output] = zp
+    points, sampled = sample_arrays(
+        tri['points'][["X", "Y"]].values,
+        tri['vertices'][list(col)].values.astype(float),
+        tri["locator"],
+        workers=workers)
 
+    tri['points'].loc[tri['points'].index[points], list(col_output)] = sampled
 
     return tri
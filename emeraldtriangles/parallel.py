@@ -0,0 +1,45 @@
+import os
+import multiprocessing
+import concurrent.futures
+
+import logging
+logger = logging.getLogger(__name__)
+
+_shared = None
+
+def _init_worker(shared):
+    global _shared
+    _shared = shared
+
+def _call(func, args):
+    return func(_shared, *args)
+
+def resolve_workers(workers):
+    "Number of worker processes for a workers argument (None/1: none, -1: one per cpu)"
+    if workers is None:
+        return 1
+    if workers < 0:
+        return os.cpu_count() or 1
+    return max(1, workers)
+
+def map_shared(func, shared, tasks, workers=None):
+    """Apply func(shared, *task) to each task, in a pool of worker
+    processes if workers > 1. The shared data (e.g. mesh arrays) is only
+    handed to each worker process once, when it starts, and is not
+    copied at all where worker processes are forked. Only the tasks and
+    results are sent between processes.
+
+    Returns the results in the order of tasks.
+    """
+    tasks = list(tasks)
+    workers = min(resolve_workers(workers), len(tasks))
+    if workers <= 1:
+        return [func(shared, *task) for task in tasks]
+
+    context = None
+    if "fork" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("fork")
+    logger.info(f"map_shared: running {len(tasks)} tasks on {workers} workers")
+    with concurrent.futures.ProcessPoolExecutor(
+            workers, mp_context=context, initializer=_init_worker, initargs=(shared,)) as pool:
+        return list(pool.map(_call, [func] * len(tasks), tasks))
@@ -1,5 +1,8 @@
 import numpy as np
 import pandas as pd
+import zlib
+
+from . import parallel
 
 import logging
 logger = logging.getLogger(__name__)
@@ -32,23 +35,382 @@ def points_in_triangle(PS, A,B,C):
         a, b, c = A[bboxfilter], B[bboxfilter], C[bboxfilter]        
         matches = point_in_triangle(P, a,b,c)
         yield bboxfilter[matches]
-        
 
-def points_in_triangles(points, vertices, triangles, **kw):
+def _ragged_offsets(counts):
+    "For each element of the concatenation of ranges of lengths counts, its position within its range"
+    return np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+
+class TriangleIndex(object):
+    """Uniform grid bucket index over the bounding boxes of a set of
+    triangles, used to locate large numbers of points in a mesh.
+
+    Every triangle is registered in each grid cell its bounding box
+    overlaps, and the triangles of each cell are stored contiguously
+    (CSR layout) in ascending triangle order. A query looks up the cell
+    of each point and runs the exact point in triangle test only
+    against the triangles registered in that cell.
+
+    Parameters
+    -----------
+    A, B, C : np.ndarray[M,2]
+      Coordinates of the three corners of each triangle.
+    cell_size : float
+      Grid cell size. By default, chosen from the median triangle
+      bounding box size, limited so that the grid has at most about
+      4 cells per triangle.
+    """
+    def __init__(self, A, B, C, cell_size=None):
+        self.A = A
+        self.B = B
+        self.C = C
+
+        mi = np.minimum(np.minimum(A, B), C)
+        ma = np.maximum(np.maximum(A, B), C)
+
+        if len(A):
+            self.origin = mi.min(axis=0)
+            extent = ma.max(axis=0) - self.origin
+        else:
+            self.origin = np.zeros(2)
+            extent = np.zeros(2)
+
+        if cell_size is None and len(A):
+            cell_size = max(np.median((ma - mi).max(axis=1)),
+                            np.sqrt(extent[0] * extent[1] / (4 * len(A))))
+        if not cell_size or not np.isfinite(cell_size) or cell_size <= 0:
+            cell_size = max(extent.max(), 1.)
+        self.cell_size = cell_size
+        self.shape = np.floor(extent / cell_size).astype(np.int64) + 1
+
+        lo = self._cells(mi)
+        hi = self._cells(ma)
+        width = hi[:,0] - lo[:,0] + 1
+        counts = width * (hi[:,1] - lo[:,1] + 1)
+
+        tri_idx = np.repeat(np.arange(len(A)), counts)
+        offsets = _ragged_offsets(counts)
+        width = width[tri_idx]
+        cells = ((lo[tri_idx,1] + offsets // width) * self.shape[0]
+                 + lo[tri_idx,0] + offsets % width)
+
+        # A stable sort keeps triangles in ascending order within each cell
+        order = np.argsort(cells, kind="stable")
+        self.cell_triangles = tri_idx[order]
+        self.cell_start = np.concatenate((
+            [0], np.cumsum(np.bincount(cells, minlength=self.shape.prod()))))
+
+    def _cells(self, P):
+        return np.floor((P - self.origin) / self.cell_size).astype(np.int64)
+
+    def query(self, P, chunk_size=100000):
+        """Find the triangle containing each point in P (np.ndarray[N,2]).
+        Returns an array with the index of the first (lowest index)
+        triangle containing each point, or -1 for points outside of
+        all triangles."""
+        res = np.full(len(P), -1, dtype=int)
+        cells = self._cells(P)
+        valid = np.all((cells >= 0) & (cells < self.shape), axis=1)
+        cells = cells[:,1] * self.shape[0] + cells[:,0]
+
+        for start in range(0, len(P), chunk_size):
+            points = start + np.flatnonzero(valid[start:start + chunk_size])
+            cell = cells[points]
+            cell_start = self.cell_start[cell]
+            counts = self.cell_start[cell + 1] - cell_start
+
+            candidate_points = np.repeat(points, counts)
+            candidates = self.cell_triangles[np.repeat(cell_start, counts) + _ragged_offsets(counts)]
+
+            matches = point_in_triangle(
+                P[candidate_points], self.A[candidates], self.B[candidates], self.C[candidates])
+            candidate_points = candidate_points[matches]
+            candidates = candidates[matches]
+
+            # candidate_points is sorted, so keep the first match for each point
+            first = np.diff(candidate_points, prepend=-1) != 0
+            res[candidate_points[first]] = candidates[first]
+        return res
+
+def triangle_neighbours(faces):
+    """Neighbour table for a triangle mesh.
+
+    faces : np.ndarray[M,3]
+      Vertex indices (positions) of the corners of each triangle.
+
+    Returns np.ndarray[M,3] where column i holds the index of the
+    triangle sharing the edge opposite corner i, or -1 for boundary
+    edges.
+    """
+    faces = np.asarray(faces, dtype=np.int64)
+    a = faces[:,[1, 2, 0]].ravel()
+    b = faces[:,[2, 0, 1]].ravel()
+    keys = np.minimum(a, b) * (faces.max(initial=0) + 1) + np.maximum(a, b)
+    order = np.argsort(keys, kind="stable")
+    pairs = np.flatnonzero(keys[order][1:] == keys[order][:-1])
+
+    neighbours = np.full(len(keys), -1, dtype=np.int64)
+    neighbours[order[pairs]] = order[pairs + 1] // 3
+    neighbours[order[pairs + 1]] = order[pairs] // 3
+    return neighbours.reshape((-1, 3))
+
+def _walk(P, points, start, corners, area, neighbours, max_steps):
+    """Walk from the triangles start towards each of the points P[points],
+    all walks advancing in lockstep. Returns the triangle reached for
+    each point, or -1 if the walk left the mesh or ran out of steps."""
+    ax, ay, bx, by, cx, cy = corners
+    res = np.full(len(points), -1, dtype=int)
+    current = np.array(start, dtype=int)
+    active = np.flatnonzero(current >= 0)
+    px, py = P[points, 0], P[points, 1]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for step in range(max_steps):
+            if not len(active): break
+            t = current[active]
+            x, y = px[active], py[active]
+            d = area[t]
+            l0 = ((bx[t] - x) * (cy[t] - y) - (by[t] - y) * (cx[t] - x)) / d
+            l1 = ((cx[t] - x) * (ay[t] - y) - (cy[t] - y) * (ax[t] - x)) / d
+            l2 = 1. - l0 - l1
+            inside = (l0 >= 0) & (l1 >= 0) & (l2 >= 0)
+            res[active[inside]] = t[inside]
+            # Step across the edge the point is furthest outside of
+            edge = np.where((l0 <= l1) & (l0 <= l2), 0, np.where(l1 <= l2, 1, 2))
+            nxt = neighbours[t, edge]
+            walking = ~inside & (nxt >= 0) & (d != 0)
+            active = active[walking]
+            current[active] = nxt[walking]
+    return res
+
+def walk_points_in_triangles(P, A, B, C, neighbours, index=None, start=-1, max_steps=16, segment_length=64):
+    """Locate a stream of points by walking the mesh from the triangle
+    of the previous point to the next one. For spatially coherent
+    point orders (flight lines, profiles, raster scanlines) each point
+    is only a few steps away from the previous one.
+
+    The stream is split into segments of consecutive points that are
+    walked simultaneously, one point per segment at a time, so that
+    the walks are vectorized. Segment heads, and points where the walk
+    leaves the mesh or does not arrive within max_steps, are located
+    using index (a TriangleIndex) instead.
+
+    Parameters
+    -----------
+    P : np.ndarray[N,2]
+      Points to locate, in stream order.
+    A, B, C : np.ndarray[M,2]
+      Coordinates of the three corners of each triangle.
+    neighbours : np.ndarray[M,3]
+      As returned by triangle_neighbours().
+    index : TriangleIndex
+      Index used for points the walk can not locate. Built on demand
+      if not given.
+    start : int
+      Triangle to start walking to the first point from (warm start,
+      e.g. the triangle of the last point of a previous stream
+      chunk). If -1, the first point is located using the index.
+    max_steps : int
+      Maximum number of triangles to visit for a single point.
+    segment_length : int
+      Maximum number of consecutive points in each segment.
+
+    Returns an array with the index of the triangle containing each
+    point, or -1 for points outside of all triangles. Points on an edge
+    shared by two triangles can be reported in either of them.
+    """
+    res = np.full(len(P), -1, dtype=int)
+    if len(A) == 0 or len(P) == 0:
+        return res
+    if index is None:
+        index = TriangleIndex(A, B, C)
+
+    corners = (A[:,0].copy(), A[:,1].copy(), B[:,0].copy(), B[:,1].copy(), C[:,0].copy(), C[:,1].copy())
+    area = ((B[:,0] - A[:,0]) * (C[:,1] - A[:,1])
+            - (B[:,1] - A[:,1]) * (C[:,0] - A[:,0]))
+
+    segment_length = max(1, min(segment_length, int(np.sqrt(len(P)))))
+    heads = np.arange(0, len(P), segment_length)
+    current = np.full(len(heads), -1, dtype=int)
+    current[0] = start
+
+    unresolved = []
+    for offset in range(segment_length):
+        walkers = np.flatnonzero(heads + offset < len(P))
+        if not len(walkers): break
+        points = heads[walkers] + offset
+
+        seeded = current[walkers] >= 0
+        res[points[~seeded]] = index.query(P[points[~seeded]])
+
+        found = _walk(P, points[seeded], current[walkers[seeded]], corners, area, neighbours, max_steps)
+        res[points[seeded]] = found
+        unresolved.append(points[seeded][found < 0])
+
+        found = res[points]
+        current[walkers[found >= 0]] = found[found >= 0]
+
+    unresolved = np.concatenate(unresolved)
+    res[unresolved] = index.query(P[unresolved])
+    return res
+
+def mesh_fingerprint(vertices, triangles):
+    """Cheap checksum of the vertex coordinates, vertex index and
+    triangle corners of a triangulation, used to detect changes to a
+    mesh."""
+    return (len(vertices), len(triangles),
+            zlib.crc32(np.ascontiguousarray(vertices[["X", "Y"]].values, dtype=float)),
+            zlib.crc32(np.ascontiguousarray(vertices.index.values)),
+            zlib.crc32(np.ascontiguousarray(triangles[[0, 1, 2]].values)))
+
+class MeshLocator(object):
+    """Point location and sampling data precomputed for a
+    triangulation: vertex coordinates, triangle corners (as positions
+    into vertices), corner coordinates and, built on first use, a
+    TriangleIndex and a triangle neighbour table (taken from the
+    MeshTopology of the triangulation if given and still valid).
+
+    Build one with mesh_locator() to store it in tri["locator"], where
+    it is picked up and reused by points_in_triangles(),
+    sample_points(), sample_from_triangulation() and
+    replace_triangles(). It is rebuilt automatically if the vertex
+    coordinates or triangles change.
+
+    Parameters
+    -----------
+    vertices : DataFrame
+      Vertices with columns X and Y
+    triangles : DataFrame
+      Triangles with columns 0, 1, 2 with indices into vertices
+    topology : MeshTopology
+      Topology of the triangulation, optional
+    """
+    def __init__(self, vertices, triangles, topology=None, **kw):
+        self.fingerprint = mesh_fingerprint(vertices, triangles)
+        self.xy = np.ascontiguousarray(vertices[["X", "Y"]].values, dtype=float)
+        self.faces = np.column_stack([
+            vertices.index.get_indexer(triangles[col].values) for col in (0, 1, 2)
+        ]).reshape((-1, 3))
+        if (self.faces < 0).any():
+            raise KeyError("Triangles reference vertices missing from the vertex index")
+        self.A = self.xy[self.faces[:,0]]
+        self.B = self.xy[self.faces[:,1]]
+        self.C = self.xy[self.faces[:,2]]
+        self._index = None
+        self._neighbours = None
+        if topology is not None and topology.is_valid(vertices, triangles):
+            self._neighbours = topology.neighbours
+        # Last triangle found, to warm start walks on the next call
+        self.last = -1
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = TriangleIndex(self.A, self.B, self.C)
+        return self._index
+
+    @property
+    def neighbours(self):
+        if self._neighbours is None:
+            self._neighbours = triangle_neighbours(self.faces)
+        return self._neighbours
+
+    def is_valid(self, vertices, triangles):
+        "Check if this locator still matches vertices and triangles"
+        return self.fingerprint == mesh_fingerprint(vertices, triangles)
+
+    def locate(self, P, method="index", workers=None, **kw):
+        """Find the triangle containing each point in P (np.ndarray[N,2]),
+        or -1 for points outside of the mesh. See points_in_triangles()
+        for method, workers and the extra keyword arguments."""
+        if len(self.faces) == 0:
+            return np.full(len(P), -1, dtype=int)
+        if method not in ("index", "walk"):
+            raise NotImplementedError("Unknown point location method %s..." % (method,))
+        kw = {key: value for key, value in kw.items() if key in ("start", "max_steps", "segment_length")}
+        if method == "walk":
+            kw.setdefault("start", self.last)
+
+        if parallel.resolve_workers(workers) > 1:
+            # Build everything the workers need before they start
+            self.index
+            if method == "walk":
+                self.neighbours
+            chunks = self.chunks(P, parallel.resolve_workers(workers), spatial = method == "index")
+            found = np.full(len(P), -1, dtype=int)
+            for chunk, chunk_found in zip(chunks, parallel.map_shared(
+                    _locate_chunk, self,
+                    [(P[chunk], method, kw if idx == 0 else dict(kw, start=-1))
+                     for idx, chunk in enumerate(chunks)],
+                    workers)):
+                found[chunk] = chunk_found
+        else:
+            found = _locate_chunk(self, P, method, kw)
+
+        hits = found[found >= 0]
+        if len(hits):
+            self.last = hits[-1]
+        return found
+
+    def chunks(self, P, workers, spatial=True, chunks_per_worker=4):
+        """Split the points P into chunks for parallel processing. If
+        spatial, the chunks are spatially coherent groups of points
+        (consecutive runs of grid cells of the index), otherwise
+        consecutive runs of points. Returns a list of arrays of
+        positions into P."""
+        n = min(len(P), workers * chunks_per_worker)
+        if spatial:
+            cells = self.index._cells(P)
+            order = np.argsort(cells[:,1] * self.index.shape[0] + cells[:,0], kind="stable")
+        else:
+            order = np.arange(len(P))
+        return [chunk for chunk in np.array_split(order, max(n, 1)) if len(chunk)]
+
+def _locate_chunk(locator, P, method, kw):
+    if method == "index":
+        return locator.index.query(P)
+    return walk_points_in_triangles(
+        P, locator.A, locator.B, locator.C, locator.neighbours, locator.index, **kw)
+
+def get_locator(**tri):
+    """Return tri["locator"] if it is still valid for the triangulation,
+    otherwise build a new MeshLocator."""
+    locator = tri.get("locator", None)
+    if locator is None or not locator.is_valid(tri["vertices"], tri["triangles"]):
+        locator = MeshLocator(**tri)
+    return locator
+
+def mesh_locator(**tri):
+    """Build (or validate) the MeshLocator of a triangulation and store
+    it in tri["locator"], so that repeated sampling of the same mesh
+    does not redo the point location setup."""
+    tri["locator"] = get_locator(**tri)
+    return tri
+
+def points_in_triangles(points, vertices, triangles, method="index", locator=None, workers=None, **kw):
     """
     points: DataFrame with columns X and Y
     vertices: DataFrame with columns X and Y
     triangles: DataFrame with columns 0, 1, 2 with indices into vertices
+    method: "index" to look up all points in a spatial index, or "walk"
+      to walk the mesh from the triangle of each point to the next,
+      which is faster for spatially ordered points (flight lines,
+      profiles, scanlines). Extra keyword arguments (start, max_steps,
+      segment_length) are passed to walk_points_in_triangles().
+    locator: MeshLocator to reuse, if still valid for vertices and triangles.
+    workers: Number of worker processes (-1 for one per cpu) to split
+      the points between. With method="index", the points are split
+      into spatially coherent chunks, with method="walk" into runs of
+      consecutive points.
     Returns:
     DataFrame with columns point and triangle with indices into points and triangles respectively.
     """
+    if len(triangles) == 0:
+        return pd.DataFrame(columns = ["point", "triangle"], dtype = int)
+
+    locator = get_locator(vertices=vertices, triangles=triangles, locator=locator)
     P = points[["X", "Y"]].values
-    A = vertices.loc[triangles[0].values][["X", "Y"]].values
-    B = vertices.loc[triangles[1].values][["X", "Y"]].values
-    C = vertices.loc[triangles[2].values][["X", "Y"]].values
 
-    points_and_triangles = pd.DataFrame([
-        (idx, matches[0] if len(matches) > 0 else -1)
-        for idx, matches in enumerate(points_in_triangle(P, A, B, C))], columns = ["point", "triangle"], dtype = int)
+    points_and_triangles = pd.DataFrame({
+        "point": np.arange(len(P)),
+        "triangle": locator.locate(P, method, workers, **kw)}, columns = ["point", "triangle"], dtype = int)
     logger.info(f"points_in_triangles: completed")
     return points_and_triangles
@@ -1,8 +1,113 @@
 import numpy as np
 import rasterio
+import rasterio.windows
 import pyproj
+import concurrent.futures
 
-def interpolate_from_raster(raster, col="topo", projection=None, overwrite_existing=True, **tri):
+from . import points_in_mesh
+
+def _pixel_coordinates(transform, x, y):
+    """Fractional pixel coordinates (col, row) of the points x, y, with
+    integer values at pixel corners, so that np.floor() gives the pixel
+    each point falls in (same as rasterio's index())."""
+    det = transform.a * transform.e - transform.b * transform.d
+    dx = x - transform.c
+    dy = y - transform.f
+    return ((transform.e * dx - transform.b * dy) / det,
+            (transform.a * dy - transform.d * dx) / det)
+
+def sample_raster_arrays(raster, x, y, bands=1, method="nearest", block_size=4096):
+    """Sample raster bands at points given in the crs of the raster.
+
+    The raster window covering the points is read as arrays, block by
+    block of at most block_size x block_size pixels, and the points are
+    mapped to pixels with vectorized affine math.
+
+    Parameters
+    -----------
+    raster : rasterio.io.DatasetReader
+      Raster to sample from.
+    x, y : np.ndarray[N]
+      Point coordinates.
+    bands : int or list of int
+      Band(s) to sample.
+    method : str
+      "nearest" for the value of the pixel each point falls in,
+      "bilinear" for bilinear interpolation between the centers of the
+      four surrounding pixels (ignoring nodata pixels).
+    block_size : int
+      Maximum width and height of each window read.
+
+    Returns np.ndarray[N, len(bands)] of floats, with NaN for nodata
+    and for points outside of the raster.
+    """
+    bands = [bands] if np.isscalar(bands) else list(bands)
+    res = np.full((len(x), len(bands)), np.nan)
+    if method not in ("nearest", "bilinear"):
+        raise NotImplementedError("Unknown raster sampling method %s..." % (method,))
+
+    cols, rows = _pixel_coordinates(raster.transform, np.asarray(x, dtype=float), np.asarray(y, dtype=float))
+    inside = (cols >= 0) & (cols <= raster.width) & (rows >= 0) & (rows <= raster.height)
+    if method == "bilinear":
+        # Pixel centers at integer coordinates
+        cols = cols - 0.5
+        rows = rows - 0.5
+        pad = 1
+    else:
+        pad = 0
+    # Points on the right/bottom edge belong to the last column/row
+    col_idx = np.minimum(np.floor(cols), raster.width - 1)
+    row_idx = np.minimum(np.floor(rows), raster.height - 1)
+    points = np.flatnonzero(inside)
+    if not len(points):
+        return res
+    col_idx = col_idx[points].astype(np.int64)
+    row_idx = row_idx[points].astype(np.int64)
+
+    nodata = [raster.nodatavals[band - 1] for band in bands]
+
+    block_col = (col_idx + pad) // block_size
+    block_row = (row_idx + pad) // block_size
+    block_key = block_row * (raster.width // block_size + 2) + block_col
+    order = np.argsort(block_key, kind="stable")
+    starts = np.flatnonzero(np.diff(block_key[order], prepend=-1))
+    for block_points in np.split(order, starts[1:]):
+        c = col_idx[block_points]
+        r = row_idx[block_points]
+        col_off = max(c.min(), 0)
+        row_off = max(r.min(), 0)
+        window = rasterio.windows.Window(
+            col_off, row_off,
+            min(c.max() + pad + 1, raster.width) - col_off,
+            min(r.max() + pad + 1, raster.height) - row_off)
+        data = raster.read(bands, window=window).astype(float)
+        for band, band_nodata in enumerate(nodata):
+            if band_nodata is not None:
+                data[band][data[band] == band_nodata] = np.nan
+
+        if method == "nearest":
+            res[points[block_points]] = data[:, r - row_off, c - col_off].T
+            continue
+
+        fc = cols[points[block_points]] - c
+        fr = rows[points[block_points]] - r
+        values = np.zeros((len(block_points), len(bands)))
+        weights = np.zeros((len(block_points), len(bands)))
+        for dr, dc, w in ((0, 0, (1 - fr) * (1 - fc)), (0, 1, (1 - fr) * fc),
+                          (1, 0, fr * (1 - fc)), (1, 1, fr * fc)):
+            cc = c + dc
+            rr = r + dr
+            valid = (cc >= 0) & (cc < raster.width) & (rr >= 0) & (rr < raster.height)
+            v = np.full((len(block_points), len(bands)), np.nan)
+            v[valid] = data[:, rr[valid] - row_off, cc[valid] - col_off].T
+            w = np.where(np.isnan(v), 0., w[:,None])
+            values += np.nan_to_num(v) * w
+            weights += w
+        with np.errstate(invalid="ignore", divide="ignore"):
+            res[points[block_points]] = np.where(weights > 0, values / weights, np.nan)
+    return res
+
+def interpolate_from_raster(raster, col="topo", projection=None, overwrite_existing=True, bands=1, method="sample", block_size=4096, **tri):
     """Sample vertice data from a raster image. Coordinate reprojection is
     done using the crs of the raster and the supplied projection or
     tri["meta"]["projection"].
@@ -11,10 +116,21 @@ def interpolate_from_raster(raster, col="topo", projection=None, overwrite_exist
     -----------
     raster : rasterio.io.DatasetReader
       Raster to sample from.
-    col : str
-      Name of column to store sampled values in.
+    col : str or list of str
+      Name of column to store sampled values in. A list of names,
+      matching bands, to sample several bands in one pass.
     projection : int
       CRS for the X and Y columns of the triangulation, optional.
+    bands : int or list of int
+      Band(s) to sample, matching col.
+    method : str
+      "sample" to sample pixel by pixel using raster.sample(),
+      "nearest" or "bilinear" to read the raster window covering the
+      vertices as arrays (see sample_raster_arrays()), which is much
+      faster for many vertices.
+    block_size : int
+      Maximum width and height of each window read for the nearest and
+      bilinear methods.
     """
 
     if projection is None:
@@ -26,16 +142,283 @@ def interpolate_from_raster(raster, col="topo", projection=None, overwrite_exist
     
     filt = (  (xy[:,0] >= raster.bounds.left) & (xy[:,0] <= raster.bounds.right)
             & (xy[:,1] >= raster.bounds.bottom) & (xy[:,1] <= raster.bounds.top))
+
+    cols = [col] if isinstance(col, str) else list(col)
+    bands = [bands] if np.isscalar(bands) else list(bands)
+    if len(cols) != len(bands):
+        raise ValueError("col and bands must be of the same length")
+
+    if method == "sample":
+        if not overwrite_existing:
+            filt = filt & tri['vertices'].reindex(columns=cols).isna().any(axis=1).values
+        filt = tri["vertices"].index[filt].values
+
+        sampled = np.array(list(raster.sample([tuple(l) for l in xy[filt,:]], indexes=bands))).reshape((-1, len(bands)))
+        for idx, (c, band) in enumerate(zip(cols, bands)):
+            datafilt = sampled[:,idx] != raster.nodatavals[band - 1]
+            if not overwrite_existing and c in tri["vertices"].columns:
+                datafilt &= tri["vertices"].loc[filt, c].isna().values
+            tri["vertices"].loc[filt[datafilt], c] = sampled[datafilt, idx]
+        return tri
+
     if not overwrite_existing:
-        filt = filt & tri['vertices'][col].isna().values
-    filt = tri["vertices"].index[filt].values
+        filt = filt & tri['vertices'].reindex(columns=cols).isna().any(axis=1).values
+    filt = np.flatnonzero(filt)
+
+    sampled = sample_raster_arrays(raster, xy[filt,0], xy[filt,1], bands, method, block_size)
+
+    index = tri["vertices"].index
+    for idx, c in enumerate(cols):
+        valid = ~np.isnan(sampled[:,idx])
+        if not overwrite_existing and c in tri["vertices"].columns:
+            valid &= tri["vertices"][c].isna().values[filt]
+        tri["vertices"].loc[index[filt[valid]], c] = sampled[valid, idx]
+    return tri
+
+def _sample_mosaic_tile(source, x, y, bands, method, block_size):
+    if isinstance(source, rasterio.io.DatasetReader):
+        return sample_raster_arrays(source, x, y, bands, method, block_size)
+    with rasterio.open(source) as raster:
+        return sample_raster_arrays(raster, x, y, bands, method, block_size)
+
+def interpolate_from_rasters(rasters, col="topo", projection=None, overwrite_existing=True, bands=1, method="nearest", workers=4, block_size=4096, **tri):
+    """Sample vertice data from a mosaic of (possibly overlapping)
+    raster tiles. Each vertex gets its value from the highest priority
+    tile that covers it with data (not nodata).
+
+    Vertex coordinates are reprojected once per distinct crs among the
+    tiles, and each tile is only handed the vertices inside its bounds,
+    found using an index of the vertices sorted by x coordinate. Tiles
+    are read concurrently in a thread pool.
+
+    Parameters
+    -----------
+    rasters : list
+      Tiles as rasterio.io.DatasetReader or file paths, in priority
+      order (highest first), or (raster, priority) tuples where the
+      highest priority wins.
+    col : str or list of str
+      Name of column to store sampled values in, or list of names
+      matching bands.
+    projection : int
+      CRS for the X and Y columns of the triangulation, optional.
+    overwrite_existing : bool
+      If false, only sample vertices with NaN in col.
+    bands : int or list of int
+      Band(s) to sample, matching col.
+    method : str
+      "nearest" or "bilinear", see sample_raster_arrays().
+    workers : int
+      Number of tiles to read concurrently.
+    block_size : int
+      Maximum width and height of each window read.
+    """
+    if projection is None:
+        projection = tri["meta"]["projection"]
+    cols = [col] if isinstance(col, str) else list(col)
+    bands = [bands] if np.isscalar(bands) else list(bands)
+    if len(cols) != len(bands):
+        raise ValueError("col and bands must be of the same length")
 
+    tiles = [raster if isinstance(raster, tuple) else (raster, -idx)
+             for idx, raster in enumerate(rasters)]
+    tiles = sorted(tiles, key=lambda tile: tile[1], reverse=True)
 
-    sampled = np.array(list(raster.sample([tuple(l) for l in xy[filt,:]])))[:,0]
-    datafilt = ~np.isin(sampled, raster.get_nodatavals())
+    vertices = tri["vertices"]
+    candidates = np.arange(len(vertices))
+    if not overwrite_existing:
+        candidates = np.flatnonzero(vertices.reindex(columns=cols).isna().any(axis=1).values)
+
+    # Reproject once per crs and sort by x, so that the vertices
+    # within the bounds of a tile can be found by bisection
+    transformed = {}
+    tasks = []
+    for source, priority in tiles:
+        if isinstance(source, rasterio.io.DatasetReader):
+            crs, bounds = source.crs, source.bounds
+        else:
+            with rasterio.open(source) as raster:
+                crs, bounds = raster.crs, raster.bounds
+        key = crs.to_wkt()
+        if key not in transformed:
+            x, y = pyproj.Transformer.from_crs(int(projection), key, always_xy=True
+            ).transform(vertices["X"].values[candidates], vertices["Y"].values[candidates])
+            order = np.argsort(x, kind="stable")
+            transformed[key] = (x[order], y[order], candidates[order])
+        x, y, idx = transformed[key]
+        start = np.searchsorted(x, bounds.left, side="left")
+        end = np.searchsorted(x, bounds.right, side="right")
+        inside = start + np.flatnonzero((y[start:end] >= bounds.bottom) & (y[start:end] <= bounds.top))
+        tasks.append((source, x[inside], y[inside], idx[inside]))
 
-    filt = filt[datafilt]
-    sampled = sampled[datafilt]
+    with concurrent.futures.ThreadPoolExecutor(max(1, workers)) as pool:
+        futures = [pool.submit(_sample_mosaic_tile, source, x, y, bands, method, block_size)
+                   for source, x, y, idx in tasks]
+        sampled = np.full((len(vertices), len(bands)), np.nan)
+        # Highest priority first, lower priority tiles only fill in
+        # vertices without data so far
+        for (source, x, y, idx), future in zip(tasks, futures):
+            values = future.result()
+            missing = np.isnan(sampled[idx])
+            sampled[idx] = np.where(missing, values, sampled[idx])
 
-    tri["vertices"].loc[filt, col] = sampled
+    index = vertices.index
+    for band_idx, c in enumerate(cols):
+        valid = ~np.isnan(sampled[:,band_idx])
+        if not overwrite_existing and c in vertices.columns:
+            valid &= vertices[c].isna().values
+        vertices.loc[index[valid], c] = sampled[valid, band_idx]
     return tri
+
+def rasterize_tiles(columns, transform, width, height, tile_size=1024, **tri):
+    """Rasterize vertex columns of a triangulation onto a regular grid,
+    tile by tile, using barycentric interpolation within each triangle.
+
+    Triangles are bucketed by the tiles their bounding boxes overlap,
+    and within a tile each triangle only tests the pixel centers inside
+    its bounding box, so each tile costs about the number of pixels it
+    contains, independent of the mesh size.
+
+    Parameters
+    -----------
+    columns : list of str
+      Vertex columns to rasterize (one band each).
+    transform : affine.Affine
+      Transform of the output grid (pixel to crs of X and Y).
+    width, height : int
+      Size of the output grid in pixels.
+    tile_size : int
+      Width and height of each tile.
+    **tri
+      Triangulation to rasterize.
+
+    Yields (window, data) for each tile, with window being a
+    rasterio.windows.Window and data a np.ndarray[len(columns),
+    window.height, window.width] of floats, NaN outside of the mesh.
+    """
+    locator = points_in_mesh.get_locator(**tri)
+    values = tri["vertices"][columns].values.astype(float)
+    faces = locator.faces
+
+    # Corners in pixel coordinates (barycentric weights are preserved
+    # by the affine transform)
+    cols, rows = _pixel_coordinates(transform, locator.xy[:,0], locator.xy[:,1])
+    cc = cols[faces]
+    rr = rows[faces]
+
+    # Range of pixels (by center) within the bounding box of each triangle
+    col_lo = np.maximum(np.ceil(cc.min(axis=1) - 0.5), 0)
+    col_hi = np.minimum(np.floor(cc.max(axis=1) - 0.5), width - 1)
+    row_lo = np.maximum(np.ceil(rr.min(axis=1) - 0.5), 0)
+    row_hi = np.minimum(np.floor(rr.max(axis=1) - 0.5), height - 1)
+    valid = np.flatnonzero((col_lo <= col_hi) & (row_lo <= row_hi))
+    col_lo, col_hi, row_lo, row_hi = (a[valid].astype(np.int64) for a in (col_lo, col_hi, row_lo, row_hi))
+
+    # Bucket triangles by tile
+    tiles_x = (width + tile_size - 1) // tile_size
+    tiles_y = (height + tile_size - 1) // tile_size
+    tile_width = col_hi // tile_size - col_lo // tile_size + 1
+    counts = tile_width * (row_hi // tile_size - row_lo // tile_size + 1)
+    tile_tris = np.repeat(np.arange(len(valid)), counts)
+    offsets = points_in_mesh._ragged_offsets(counts)
+    tile_width = tile_width[tile_tris]
+    tile_keys = ((row_lo[tile_tris] // tile_size + offsets // tile_width) * tiles_x
+                 + col_lo[tile_tris] // tile_size + offsets % tile_width)
+    order = np.argsort(tile_keys, kind="stable")
+    tile_tris = tile_tris[order]
+    tile_start = np.concatenate(([0], np.cumsum(np.bincount(tile_keys, minlength=tiles_x * tiles_y))))
+
+    for tile_row in range(tiles_y):
+        for tile_col in range(tiles_x):
+            row_off = tile_row * tile_size
+            col_off = tile_col * tile_size
+            window = rasterio.windows.Window(
+                col_off, row_off,
+                min(tile_size, width - col_off), min(tile_size, height - row_off))
+            data = np.full((len(columns), window.height, window.width), np.nan)
+
+            key = tile_row * tiles_x + tile_col
+            t = tile_tris[tile_start[key]:tile_start[key + 1]]
+            if len(t):
+                c0 = np.maximum(col_lo[t], col_off)
+                c1 = np.minimum(col_hi[t], col_off + window.width - 1)
+                r0 = np.maximum(row_lo[t], row_off)
+                r1 = np.minimum(row_hi[t], row_off + window.height - 1)
+                w = c1 - c0 + 1
+                counts = w * (r1 - r0 + 1)
+                pixel_tris = np.repeat(t, counts)
+                offsets = points_in_mesh._ragged_offsets(counts)
+                w = np.repeat(w, counts)
+                pc = np.repeat(c0, counts) + offsets % w
+                pr = np.repeat(r0, counts) + offsets // w
+
+                tri_idx = valid[pixel_tris]
+                x = cc[tri_idx]
+                y = rr[tri_idx]
+                px = pc + 0.5
+                py = pr + 0.5
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    d = (y[:,1] - y[:,2]) * (x[:,0] - x[:,2]) + (x[:,2] - x[:,1]) * (y[:,0] - y[:,2])
+                    w0 = ((y[:,1] - y[:,2]) * (px - x[:,2]) + (x[:,2] - x[:,1]) * (py - y[:,2])) / d
+                    w1 = ((y[:,2] - y[:,0]) * (px - x[:,2]) + (x[:,0] - x[:,2]) * (py - y[:,2])) / d
+                w2 = 1 - w0 - w1
+                inside = (w0 >= 0) & (w1 >= 0) & (w2 >= 0)
+
+                weights = np.column_stack((w0[inside], w1[inside], w2[inside]))
+                sampled = np.einsum("ij,ijk->ik", weights, values[faces[tri_idx[inside]]])
+                data[:, pr[inside] - row_off, pc[inside] - col_off] = sampled.T
+            yield window, data
+
+def to_raster(raster, columns, resolution=None, transform=None, width=None, height=None, projection=None, nodata=-9999, tile_size=1024, **tri):
+    """Rasterize vertex columns of a triangulation to a raster file
+    (e.g. a GeoTIFF), one band per column, see rasterize_tiles(). Tiles
+    are written as they are produced, so the full grid is never held in
+    memory.
+
+    Parameters
+    -----------
+    raster : str or rasterio.io.DatasetWriter
+      Path of a GeoTIFF to create, or a dataset opened for writing, in
+      which case its transform, size and nodata value are used.
+    columns : str or list of str
+      Vertex column(s) to rasterize.
+    resolution : float
+      Pixel size, used with the bounds of the vertices if no transform
+      is given.
+    transform : affine.Affine
+      Transform of the output grid, with width and height.
+    projection : int
+      CRS for the X and Y columns of the triangulation. Defaults to
+      tri["meta"]["projection"] if present.
+    nodata : float
+      Value for pixels outside of the mesh or with NaN values.
+    tile_size : int
+      Width and height of the tiles processed and written at a time.
+    """
+    columns = [columns] if isinstance(columns, str) else list(columns)
+
+    if not isinstance(raster, str):
+        transform, width, height = raster.transform, raster.width, raster.height
+        if raster.nodata is not None:
+            nodata = raster.nodata
+        for window, data in rasterize_tiles(columns, transform, width, height, tile_size, **tri):
+            raster.write(np.where(np.isnan(data), nodata, data).astype(raster.dtypes[0]), window=window)
+        return raster
+
+    if transform is None:
+        vertices = tri["vertices"]
+        xmin, xmax = vertices["X"].min(), vertices["X"].max()
+        ymin, ymax = vertices["Y"].min(), vertices["Y"].max()
+        transform = rasterio.transform.from_origin(xmin, ymax, resolution, resolution)
+        width = max(1, int(np.ceil((xmax - xmin) / resolution)))
+        height = max(1, int(np.ceil((ymax - ymin) / resolution)))
+    if projection is None:
+        projection = tri.get("meta", {}).get("projection", None)
+
+    with rasterio.open(
+            raster, "w", driver="GTiff", width=width, height=height, count=len(columns),
+            dtype="float32", crs=None if projection is None else rasterio.crs.CRS.from_epsg(int(projection)),
+            transform=transform, nodata=nodata,
+            tiled=True, blockxsize=256, blockysize=256) as dst:
+        to_raster(dst, columns, tile_size=tile_size, **tri)
+    return raster
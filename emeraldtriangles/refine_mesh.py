@@ -1,13 +1,58 @@
 import numpy as np
 import pandas as pd
 import scipy.spatial
+import scipy.sparse
 import triangle
 
 from . import cleanup
 from . import points_in_mesh
 from . import boundary
+from . import parallel
+from . import topology as topology_module
+
+def _triangulate_groups(shared, group_triangles, group_starts, group_ends):
+    """Delaunay triangulate the points of each group (group_points[start:end])
+    together with the corners of the triangle containing them. Returns
+    the new faces (as vertex indices) and the triangle each replaces."""
+    P, A, B, C, corners, points_start, group_points = shared
+    faces = [np.zeros((0, 3), dtype=int)]
+    sources = [np.zeros(0, dtype=int)]
+    for triangle, start, end in zip(group_triangles, group_starts, group_ends):
+        points = group_points[start:end]
+        triangulation_points = np.append(P[points],
+                                         np.array((A[triangle],
+                                                   B[triangle],
+                                                   C[triangle])), axis=0)
+
+        # Normalization to get around floating point precision problem in scipy.spatial.Delaunay
+        triangulation_points -= triangulation_points.mean(axis=0)
+
+        triangulation = scipy.spatial.Delaunay(triangulation_points, qhull_options="QJ")
 
-def replace_triangles(points, vertices=None, triangles=None, **tri):
+        triangulation_point_indices = np.append(points + points_start, corners[triangle])
+        faces.append(triangulation_point_indices[triangulation.simplices])
+        sources.append(np.full(len(triangulation.simplices), triangle))
+    return np.concatenate(faces), np.concatenate(sources)
+
+def _balanced_batches(counts, n_batches):
+    """Split consecutive groups with the given point counts into at
+    most n_batches runs with about the same total count. Returns the
+    start of each run."""
+    cumulative = np.cumsum(counts)
+    if not len(cumulative):
+        return np.zeros(0, dtype=int)
+    bounds = np.searchsorted(cumulative, cumulative[-1] * np.arange(n_batches) / n_batches, side="right")
+    return np.unique(bounds)
+
+def replace_triangles(points, vertices=None, triangles=None, workers=None, **tri):
+    """Insert points into the mesh by retriangulating each triangle
+    containing any of them. Points outside the mesh are added as
+    vertices but returned as leftover.
+
+    If workers is given (-1 for one per cpu), triangles containing
+    several points are retriangulated in a pool of worker processes.
+    The result does not depend on the number of workers.
+    """
     if vertices is None:
         vertices = pd.DataFrame({"X": [], "Y": []})
     if triangles is None:
@@ -27,50 +72,66 @@ def replace_triangles(points, vertices=None, triangles=None, **tri):
     points_start = len(vertices)
     points_and_nodes = vertices.append(points).reset_index(drop=True)
 
-    P = points[["X", "Y"]].values
-    A = vertices.loc[triangles[0].values][["X", "Y"]].values
-    B = vertices.loc[triangles[1].values][["X", "Y"]].values
-    C = vertices.loc[triangles[2].values][["X", "Y"]].values
+    locator = points_in_mesh.get_locator(vertices=vertices, triangles=triangles, locator=tri.pop("locator", None))
+    # The mesh changes, so the topology would be stale too
+    tri.pop("topology", None)
 
+    points_and_triangles = points_in_mesh.points_in_triangles(points, vertices, triangles, locator=locator, workers=workers)
 
-
-
-    points_and_triangles = points_in_mesh.points_in_triangles(points, vertices, triangles)
-
-
-    mask = np.zeros(triangles.index.shape, dtype="bool")
-    mask[:] = 1
-    triangles_with_points = np.unique(points_and_triangles["triangle"])
-    triangles_with_points = triangles_with_points[triangles_with_points != -1]
-    mask[triangles_with_points] = 0
-    
     leftover = None
-    all_new_faces = triangles[mask].copy()
-    for triangle, group in points_and_triangles.groupby("triangle"):
-        if triangle == -1:
-            leftover = group["point"] + points_start
-            continue
-        triangulation_points = np.append(P[group["point"]],
-                                         np.array((A[triangle],
-                                                   B[triangle],
-                                                   C[triangle])), axis=0)
-
-        # Normalization to get around floating point precision problem in scipy.spatial.Delaunay
-        triangulation_points[:,0] -= triangulation_points[:,0].mean()
-        triangulation_points[:,1] -= triangulation_points[:,1].mean()
-
-        triangulation = scipy.spatial.Delaunay(triangulation_points, qhull_options="QJ")
-
-        triangulation_point_indices = np.append((group["point"] + points_start),
-                                                np.array((triangles[0].loc[triangle],
-                                                          triangles[1].loc[triangle],
-                                                          triangles[2].loc[triangle])))
-        
-        new_faces = triangles.iloc[pd.Index([triangle]).repeat(len(triangulation.simplices))].copy()
-        new_faces[0] = triangulation_point_indices[triangulation.simplices[:,0]]
-        new_faces[1] = triangulation_point_indices[triangulation.simplices[:,1]]
-        new_faces[2] = triangulation_point_indices[triangulation.simplices[:,2]]        
-        all_new_faces = all_new_faces.append(new_faces)
+    outside = points_and_triangles["triangle"] == -1
+    if outside.any():
+        leftover = points_and_triangles.loc[outside, "point"] + points_start
+    inside = points_and_triangles[~outside]
+
+    # Group the points by triangle
+    order = np.argsort(inside["triangle"].values, kind="stable")
+    group_points = inside["point"].values[order]
+    group_triangles, group_starts, group_counts = np.unique(
+        inside["triangle"].values[order], return_index=True, return_counts=True)
+
+    corners = triangles[[0, 1, 2]].values.astype(int)
+    single = group_counts == 1
+
+    # A single point in a triangle splits it into a fan of three
+    fan_triangles = group_triangles[single]
+    fan_points = group_points[group_starts[single]] + points_start
+    fan_corners = corners[fan_triangles]
+    fan_faces = np.stack((
+        np.column_stack((fan_points, fan_corners[:,1], fan_corners[:,2])),
+        np.column_stack((fan_corners[:,0], fan_points, fan_corners[:,2])),
+        np.column_stack((fan_corners[:,0], fan_corners[:,1], fan_points))), axis=1).reshape((-1, 3))
+    fan_sources = np.repeat(fan_triangles, 3)
+
+    # Several points in a triangle are Delaunay triangulated together
+    # with its corners
+    multi_triangles = group_triangles[~single]
+    multi_starts = group_starts[~single]
+    multi_ends = multi_starts + group_counts[~single]
+    batches = np.append(_balanced_batches(group_counts[~single], 4 * parallel.resolve_workers(workers)),
+                        len(multi_triangles))
+    results = parallel.map_shared(
+        _triangulate_groups,
+        (points[["X", "Y"]].values, locator.A, locator.B, locator.C, corners, points_start, group_points),
+        [(multi_triangles[start:end], multi_starts[start:end], multi_ends[start:end])
+         for start, end in zip(batches[:-1], batches[1:])],
+        workers)
+
+    faces = np.concatenate([fan_faces] + [faces for faces, sources in results])
+    sources = np.concatenate([fan_sources] + [sources for faces, sources in results])
+    order = np.argsort(sources, kind="stable")
+    faces = faces[order]
+    sources = sources[order]
+
+    mask = np.ones(triangles.index.shape, dtype="bool")
+    mask[group_triangles] = False
+
+    # New faces keep the extra columns of the triangle they replace
+    new_faces = triangles.iloc[sources].copy()
+    new_faces[0] = faces[:,0]
+    new_faces[1] = faces[:,1]
+    new_faces[2] = faces[:,2]
+    all_new_faces = pd.concat((triangles[mask], new_faces))
 
     res = dict(tri)
     res["vertices"] = points_and_nodes
@@ -78,7 +139,24 @@ def replace_triangles(points, vertices=None, triangles=None, **tri):
     res["leftover"] = leftover
     return res
 
-def supplant_triangles(existing_boundary=False, **tri):
+def supplant_triangles(existing_boundary=False, incremental=False, **tri):
+    """Triangulate the vertices not used by any triangle (new points)
+    into the area around the existing triangles, within the convex
+    hull of all vertices (or the existing segments if
+    existing_boundary).
+
+    If incremental, only the boundary vertices of the existing mesh
+    and the new points are triangulated, and the new triangles
+    appended to the existing ones. The existing mesh is not cleaned
+    (only new points duplicating other input points are dropped), so
+    this is much faster for small extensions of large meshes.
+    """
+    # The mesh changes, so any MeshLocator would be stale. Any
+    # MeshTopology is still used for the existing mesh, and dropped
+    # from the result.
+    tri.pop("locator", None)
+    if incremental:
+        return _supplant_triangles_incremental(existing_boundary, **tri)
     if "triangles" not in tri:
         tri["triangles"] = pd.DataFrame({0: [], 1: [], 2:[]})        
 
@@ -94,11 +172,12 @@ def supplant_triangles(existing_boundary=False, **tri):
     trivertices = tri["vertices"][["X", "Y"]]
 
     res = dict(tri)
+    res.pop("topology", None)
     process_tri = {"vertices": trivertices.values}
     if "segments" in tri:
         process_tri["segments"] = tri["segments"][[0, 1]].values
     if "holes" in tri:
-        process_tri["holes"] = tri["holes"].values
+        process_tri["holes"] = np.asarray(tri["holes"])
     if "triangles" in tri and len(tri["triangles"]):
         triangles = tri["triangles"]
         holes = (trivertices.loc[triangles[0]].values
@@ -129,7 +208,8 @@ def supplant_triangles(existing_boundary=False, **tri):
     
     if "triangles" in tri:
         triangles = tri["triangles"]
-        res["triangles"] = triangles.append(triangles.iloc[0:0].append(pd.DataFrame(res["triangles"])))
+        res["triangles"] = pd.concat((triangles, pd.DataFrame(res["triangles"])), ignore_index=True)
+        res["triangles"] = res["triangles"].astype({0: int, 1: int, 2: int})
 
     res["vertices"] = tri["vertices"].append(
         pd.DataFrame(res["vertices"][len(tri["vertices"]):,:], columns=["X", "Y"]), ignore_index=True)
@@ -143,6 +223,98 @@ def supplant_triangles(existing_boundary=False, **tri):
 
     return res
 
+def _supplant_triangles_incremental(existing_boundary=False, **tri):
+    if "triangles" not in tri:
+        tri["triangles"] = pd.DataFrame({0: [], 1: [], 2:[]})
+    if not tri["triangles"].index.is_unique:
+        # Segments refer to triangles by index label
+        tri["triangles"] = tri["triangles"].reset_index(drop=True)
+    vertices = tri["vertices"]
+    triangles = tri["triangles"]
+
+    tri = boundary.mesh_boundary(**tri)
+    segments = tri.get("segments", pd.DataFrame({0: [], 1: []}))
+
+    xy = vertices[["X", "Y"]].values
+    topology = topology_module.get_topology(**tri)
+    corners = topology.faces
+    segment_ends = vertices.index.get_indexer(segments[[0, 1]].values.ravel()).reshape((-1, 2))
+
+    # Segments along interior edges of the mesh (such as the boundary
+    # of the mesh before an earlier extension) would enclose parts of
+    # the mesh without a hole seed, so only the mesh boundary and
+    # segments outside the mesh are kept
+    n = max(len(vertices), 1)
+    interior = topology.edges[topology.edge_counts > 1].astype(np.int64)
+    keys = segment_ends.min(axis=1).astype(np.int64) * n + segment_ends.max(axis=1)
+    outer = ~np.isin(keys, interior[:,0] * n + interior[:,1])
+    segments = segments[outer]
+    segment_ends = segment_ends[outer]
+
+    # Only the vertices of segments (the mesh boundary) and the new
+    # points take part in the triangulation
+    used = np.zeros(len(vertices), dtype=bool)
+    used[corners.ravel()] = True
+    on_segments = np.zeros(len(vertices), dtype=bool)
+    on_segments[segment_ends.ravel()] = True
+    local = np.flatnonzero(on_segments | ~used)
+
+    # Remove any duplicate vertices, or triangle.triangulate() is
+    # going to segfault!
+    local_xy, first, inverse = np.unique(xy[local], axis=0, return_index=True, return_inverse=True)
+    to_local = np.full(len(vertices), -1)
+    to_local[local] = inverse.reshape(-1)
+
+    process_tri = {"vertices": local_xy}
+    local_segments = [to_local[segment_ends]]
+    holes = []
+    if "holes" in tri:
+        holes.append(np.asarray(tri["holes"]))
+    if "triangle" in segments.columns:
+        # The existing triangles are holes. They contain no points,
+        # so one seed per triangle along the boundary is enough.
+        boundary_triangles = triangles.index.get_indexer(segments["triangle"].dropna().unique())
+        holes.append(xy[corners[boundary_triangles]].mean(axis=1))
+
+    if existing_boundary:
+        xmin, ymin = xy.min(axis=0)
+        xmax, ymax = xy.max(axis=0)
+
+        process_tri["vertices"] = np.append(
+            process_tri["vertices"],
+            np.array([[xmin-20,ymin-20], [xmin-20, ymax+20], [xmax+20, ymax+20], [xmax+20, ymin-20]]),
+            axis=0)
+        holes.append(np.array([[xmin-10, ymin-10]]))
+    else:
+        hull = scipy.spatial.ConvexHull(local_xy).simplices
+        local_segments.append(hull)
+        tri["segments"] = pd.concat((segments, pd.DataFrame(
+            vertices.index.values[local[first]][hull], columns=[0, 1])))
+
+    process_tri["segments"] = np.concatenate(local_segments)
+    if holes:
+        process_tri["holes"] = np.concatenate(holes)
+
+    triangle_triangulate_result = triangle.triangulate(process_tri, 'p')
+
+    res = dict(tri)
+    res.pop("topology", None)
+    res["vertices"] = pd.concat((vertices, pd.DataFrame(
+        triangle_triangulate_result["vertices"][len(local_xy):,:], columns=["X", "Y"])), ignore_index=True)
+    new_points = res["vertices"].index[len(vertices):]
+    labels = np.append(vertices.index.values[local[first]], new_points)
+
+    new_faces = labels[triangle_triangulate_result.get("triangles", np.zeros((0, 3), dtype=int))]
+    res["triangles"] = pd.concat((triangles, pd.DataFrame(new_faces)), ignore_index=True)
+    res["triangles"] = res["triangles"].astype({0: int, 1: int, 2: int})
+    res["segments"] = pd.DataFrame(labels[triangle_triangulate_result.get("segments", np.zeros((0, 2), dtype=int))])
+    # The hole seeds used here are only valid for this triangulation,
+    # so only the holes given by the caller are kept
+
+    if len(new_points):
+        res = interpolate_vertices(res, new_points)
+
+    return res
 
 def triangles_to_segments(triangles):
     return triangles[[0, 1]].append(
@@ -152,41 +324,56 @@ def triangles_to_segments(triangles):
         triangles[[1, 2]].rename(columns={2:0, 1:1})).append(
         triangles[[2, 0]].rename(columns={0:0, 2:1})).drop_duplicates().set_index(0).sort_index()
 
-def interpolate_vertices(tri, to_interpolate_idxs):
-    new_points = to_interpolate_idxs
-    
-    new_triangles = (
-          tri["triangles"][0].isin(new_points)
-        | tri["triangles"][1].isin(new_points)
-        | tri["triangles"][2].isin(new_points))
-
-    segments = triangles_to_segments(tri["triangles"].loc[new_triangles])
-
-    segments2 = segments.join(
-        tri["vertices"]
-    ).reset_index().rename(columns={"index":0}).set_index(1).join(
-        tri["vertices"][["X", "Y"]].rename(columns={"X":"X1", "Y":"Y1"}))
-
-    segments2["segment_length"] = np.sqrt(  (segments2["X1"]-segments2["X"])**2
-                                          + (segments2["Y1"]-segments2["Y"])**2)
-    segments2["segment_weight"] = 1. / segments2["segment_length"]
-    segments2 = segments2[~segments2[0].isin(new_points)]
-
+def interpolate_vertices(tri, to_interpolate_idxs, tolerance=1e-6, max_iterations=100):
+    """Interpolate all float columns (except X, Y and any columns in
+    tri["no_interpolation"]) to the vertices to_interpolate_idxs from
+    their neighbours along triangle edges, weighted by inverse edge
+    length. NaN values are ignored.
+
+    New vertices that only neighbour other new vertices get values in
+    later iterations, and values are iterated until no value changes
+    by more than tolerance, or for at most max_iterations iterations.
+    Use max_iterations=1 to only interpolate from neighbours that are
+    not new.
+    """
+    vertices = tri["vertices"]
+    no_interpolation = set(("X", "Y")).union(set(tri.get("no_interpolation", ())))
     # We can only interpolate floats...
-    segments2 = segments2[segments2.dtypes.index[segments2.dtypes == float]]
-    
-    segments3 = segments2.mul(
-        segments2["segment_weight"], axis=0
-    ).assign(
-        segment_weight=segments2["segment_weight"]
-    ).groupby(level=0).sum()
+    cols = [col for col, dtype in vertices.dtypes.items()
+            if dtype == float and col not in no_interpolation]
+
+    new = vertices.index.get_indexer(to_interpolate_idxs)
+    is_new = np.zeros(len(vertices), dtype=bool)
+    is_new[new] = True
+    to_new = np.full(len(vertices), -1)
+    to_new[new] = np.arange(len(new))
+
+    topology = topology_module.get_topology(**tri)
+    edges = np.concatenate((topology.edges, topology.edges[:, ::-1]))
+    edges = edges[is_new[edges[:,0]]]
+
+    xy = vertices[["X", "Y"]].values
+    lengths = np.linalg.norm(xy[edges[:,0]] - xy[edges[:,1]], axis=1)
+    adjacency = scipy.sparse.csr_matrix(
+        (1. / np.maximum(lengths, np.finfo(float).tiny), (to_new[edges[:,0]], edges[:,1])),
+        shape=(len(new), len(vertices)))
+
+    values = vertices[cols].values.astype(float)
+    original = values[new]
+    values[new] = np.nan
+    for iteration in range(max_iterations):
+        known = np.isfinite(values)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            updated = (adjacency @ np.where(known, values, 0)) / (adjacency @ known)
+        change = np.abs(updated - values[new])
+        filled = np.isfinite(updated) & ~known[new]
+        values[new] = updated
+        if not filled.any() and not (change[np.isfinite(change)] > tolerance).any():
+            break
 
-    interpolated = segments3.div(segments3["segment_weight"], axis=0)
-
-    no_interpolation = set(("X", "Y")).union(set(tri.get("no_interpolation", ())))
-    
     res = dict(tri)
-    res["vertices"] = res["vertices"].copy()
-    cols = set(interpolated.columns).intersection(set(tri["vertices"].columns)) - no_interpolation
-    res["vertices"].loc[interpolated.index, cols] = interpolated[cols]
+    res["topology"] = topology
+    res["vertices"] = vertices.copy()
+    res["vertices"].iloc[new, [vertices.columns.get_loc(col) for col in cols]] = np.where(
+        np.isfinite(values[new]), values[new], original)
     return res
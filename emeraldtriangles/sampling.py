@@ -1,15 +1,18 @@
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
 from . import points_in_mesh
+from . import parallel
 
-def sample_points(**tri):
-    # Find which triangle the point belongs to
-    points_and_triangles = points_in_mesh.points_in_triangles(**tri)
-    points_and_triangles = points_and_triangles.loc[points_and_triangles["triangle"] != -1]
-    points = tri['points'].loc[points_and_triangles.point]
-    
-    # Get X and Y coordinates for vertices for relevant triangles
-    tri_vert_np = tri['triangles'].loc[points_and_triangles.triangle.values, [0, 1, 2]].values
-    X_tri = tri['vertices'].X.values[tri_vert_np]
-    Y_tri = tri['vertices'].Y.values[tri_vert_np]
+def barycentric_weights(P, locator, found):
+    """Barycentric weights of the points P (np.ndarray[N,2]) with respect
+    to the triangles found (indices into locator.faces). Returns
+    np.ndarray[N,3] with the weights of the three corners of each
+    triangle, in the corner order of the triangles."""
+    tri_vert_np = locator.faces[found]
+    X_tri = locator.xy[tri_vert_np, 0]
+    Y_tri = locator.xy[tri_vert_np, 1]
     Y1 = Y_tri[:, 1]
     Y2 = Y_tri[:, 2]
     Y3 = Y_tri[:, 0]
@@ -17,18 +20,187 @@ def sample_points(**tri):
     X2 = X_tri[:, 2]
     X3 = X_tri[:, 0]
 
-    # compute Barycentric weights of each vertex for every query point, then compute Z
-    Px = points.X.values
-    Py = points.Y.values
-    wv1 = ((Y2 - Y3) * (Px - X3) + (X3 - X2) * (Py - Y3)) / ((Y2 - Y3) * (X1 - X3) + (X3 - X2) * (Y1 - Y3))
-    wv2 = ((Y3 - Y1) * (Px - X3) + (X1 - X3) * (Py - Y3)) / ((Y2 - Y3) * (X1 - X3) + (X3 - X2) * (Y1 - Y3))
+    Px = P[:, 0]
+    Py = P[:, 1]
+    denom = (Y2 - Y3) * (X1 - X3) + (X3 - X2) * (Y1 - Y3)
+    wv1 = ((Y2 - Y3) * (Px - X3) + (X3 - X2) * (Py - Y3)) / denom
+    wv2 = ((Y3 - Y1) * (Px - X3) + (X1 - X3) * (Py - Y3)) / denom
     wv3 = 1 - wv2 - wv1
+    return np.column_stack((wv3, wv1, wv2))
+
+def _sample_chunk(shared, P, method, kw):
+    locator, values = shared
+    found = locator.locate(P, method, **kw)
+    points = np.flatnonzero(found >= 0)
+    found = found[points]
+    weights = barycentric_weights(P[points], locator, found)
+    return points, np.einsum("ij,ijk->ik", weights, values[locator.faces[found]])
+
+def sample_arrays(P, values, locator, method="index", workers=None, **kw):
+    """Interpolate vertex values to points using barycentric
+    interpolation within the triangle each point falls in. All columns
+    of values are interpolated in one batch, sharing the point location
+    and the weights.
+
+    Parameters
+    -----------
+    P : np.ndarray[N,2]
+      Points to sample at.
+    values : np.ndarray[n_vertices, n_cols]
+      Values to interpolate, in the order of locator.xy.
+    locator : MeshLocator
+      Locator of the triangulation.
+    method : str
+      Point location method, see points_in_triangles().
+    workers : int
+      Number of worker processes (-1 for one per cpu) to split the
+      points between, in spatially coherent chunks (runs of consecutive
+      points for method="walk"). The locator and values are shared
+      with the workers, not sent with each chunk.
+
+    Returns (points, sampled) where points are the positions in P of
+    the points inside the mesh, and sampled is np.ndarray[len(points),
+    n_cols] with the values at those points.
+    """
+    if parallel.resolve_workers(workers) <= 1 or len(locator.faces) == 0 or len(P) == 0:
+        return _sample_chunk((locator, values), P, method, kw)
+
+    # Build everything the workers need before they start
+    locator.index
+    if method == "walk":
+        locator.neighbours
+    chunks = locator.chunks(P, parallel.resolve_workers(workers), spatial = method == "index")
+    results = parallel.map_shared(
+        _sample_chunk, (locator, values),
+        [(P[chunk], method, kw if idx == 0 else dict(kw, start=-1))
+         for idx, chunk in enumerate(chunks)],
+        workers)
+
+    points = np.concatenate([chunk[chunk_points] for chunk, (chunk_points, sampled) in zip(chunks, results)])
+    sampled = np.concatenate([sampled for chunk_points, sampled in results])
+    order = np.argsort(points)
+    return points[order], sampled[order]
+
+def interpolation_matrix(method="index", **tri):
+    """Sparse barycentric interpolation operator from the vertices of a
+    triangulation to tri["points"].
+
+    Returns a scipy.sparse.csr_matrix W of shape (n_points,
+    n_vertices), with the three barycentric weights of each point in
+    the columns of the corners of its triangle, so that
 
-    # Interpolate each column
-    for col in set(tri["vertices"].columns) - set(("X", "Y", "x", "y")):
-        Z_tri = tri['vertices'][col].values[tri_vert_np]
-        Pz = wv1 * Z_tri[:, 1] + wv2 * Z_tri[:, 2] + wv3 * Z_tri[:, 0]
-        tri["points"].loc[points_and_triangles.point, col] = Pz
+        W @ tri["vertices"][columns].values
 
+    samples any column, or stack of columns (e.g. one per epoch), at
+    the points. Rows of points outside of the mesh are empty (sample to
+    0). Rows and columns follow the row order of tri["points"] and
+    tri["vertices"]. The matrix can be stored between runs with
+    scipy.sparse.save_npz() and loaded with scipy.sparse.load_npz().
+
+    Parameters
+    -----------
+    method : str
+      Point location method, see points_in_triangles().
+    **tri
+      Triangulation, with the extra key points.
+    """
+    locator = points_in_mesh.get_locator(**tri)
+    P = tri["points"][["X", "Y"]].values
+    found = locator.locate(P, method)
+    points = np.flatnonzero(found >= 0)
+    found = found[points]
+    weights = barycentric_weights(P[points], locator, found)
+    return scipy.sparse.csr_matrix(
+        (weights.ravel(), (np.repeat(points, 3), locator.faces[found].ravel())),
+        shape=(len(P), len(locator.xy)))
+
+def sample_columns(vertices, exclude=("X", "Y", "x", "y")):
+    "Names of the numeric columns of vertices that can be sampled"
+    return [col for col, dtype in vertices.dtypes.items()
+            if col not in exclude
+            and pd.api.types.is_numeric_dtype(dtype)
+            and not pd.api.types.is_bool_dtype(dtype)]
+
+def sample_points(columns=None, method="index", workers=None, **tri):
+    """Sample vertex column data at tri["points"] using barycentric
+    interpolation within the triangle each point falls in. Columns are
+    added to or updated in tri["points"] in place, and points outside
+    of the mesh are left untouched.
+
+    Parameters
+    -----------
+    columns : list of str
+      Vertex columns to sample. By default all numeric columns except
+      the coordinates.
+    method : str
+      Point location method, see points_in_triangles().
+    workers : int
+      Number of worker processes, see sample_arrays().
+    **tri
+      Triangulation to sample, with the extra key points. If
+      tri["locator"] holds a valid MeshLocator, it is reused.
+    """
+    if columns is None:
+        columns = sample_columns(tri["vertices"])
+    locator = points_in_mesh.get_locator(**tri)
+    points, sampled = sample_arrays(
+        tri["points"][["X", "Y"]].values,
+        tri["vertices"][columns].values.astype(float),
+        locator, method, workers)
+    tri["points"].loc[tri["points"].index[points], columns] = sampled
     return tri["points"]
 
+def _chunk_to_points(chunk):
+    "Convert a chunk of points to a DataFrame with (at least) the columns X and Y"
+    if hasattr(chunk, "to_pandas"):
+        # pyarrow Table / RecordBatch, e.g. from ParquetFile.iter_batches()
+        chunk = chunk.to_pandas()
+    if isinstance(chunk, pd.DataFrame):
+        return chunk
+    chunk = np.asarray(chunk)
+    if chunk.dtype.names:
+        return pd.DataFrame(chunk)
+    return pd.DataFrame(chunk).rename(columns={0: "X", 1: "Y"})
+
+def sample_point_chunks(chunks, columns=None, method="index", workers=None, **tri):
+    """Sample vertex column data at a stream of point chunks, for point
+    sets too large to hold in memory. Only one chunk is processed at a
+    time, and the MeshLocator of the triangulation is built once and
+    reused for all chunks (with method="walk", the walk continues from
+    the last point of the previous chunk).
+
+    Parameters
+    -----------
+    chunks : iterable
+      Chunks of points, each being a DataFrame with columns X and Y
+      (e.g. from pandas.read_csv(..., chunksize=n)), a pyarrow Table or
+      RecordBatch (e.g. from pyarrow.parquet.ParquetFile.iter_batches())
+      or a numpy array, either structured with fields X and Y or with X
+      and Y in the first two columns.
+    columns : list of str
+      Vertex columns to sample. By default all numeric columns except
+      the coordinates.
+    method : str
+      Point location method, see points_in_triangles().
+    workers : int
+      Number of worker processes to split each chunk between, see
+      sample_arrays().
+    **tri
+      Triangulation to sample.
+
+    Yields each chunk as a DataFrame with the sampled columns added
+    (NaN for points outside of the mesh).
+    """
+    if columns is None:
+        columns = sample_columns(tri["vertices"])
+    locator = points_in_mesh.get_locator(**tri)
+    values = tri["vertices"][columns].values.astype(float)
+
+    for chunk in chunks:
+        points = _chunk_to_points(chunk).copy()
+        inside, sampled = sample_arrays(
+            points[["X", "Y"]].values, values, locator, method, workers)
+        res = np.full((len(points), len(columns)), np.nan)
+        res[inside] = sampled
+        points[columns] = res
+        yield points
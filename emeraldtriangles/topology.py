@@ -0,0 +1,110 @@
+import zlib
+import numpy as np
+
+def topology_fingerprint(vertices, triangles):
+    """Cheap checksum of the vertex index and triangle corners of a
+    triangulation, used to detect changes to its topology. Unlike
+    points_in_mesh.mesh_fingerprint(), vertex coordinates are not
+    included, as they do not change the topology."""
+    return (len(vertices), len(triangles),
+            zlib.crc32(np.ascontiguousarray(vertices.index.values)),
+            zlib.crc32(np.ascontiguousarray(triangles[[0, 1, 2]].values)))
+
+class MeshTopology(object):
+    """Edges and adjacency of a triangulation, with all vertices and
+    triangles as positions into tri["vertices"] and tri["triangles"]
+    (not index labels).
+
+    Build one with mesh_topology() to store it in tri["topology"],
+    where it is picked up and reused by mesh_boundary(),
+    interpolate_vertices(), distances_to_data(), the "mesh"
+    interpolation method and mesh walking point location. It is
+    rebuilt automatically if the triangles or the vertex index change.
+
+    Attributes
+    -----------
+    faces : np.ndarray[T,3] (int32)
+      Triangle corners.
+    edges : np.ndarray[E,2] (int32)
+      Undirected edges, lowest vertex first, sorted.
+    edge_counts : np.ndarray[E] (int32)
+      Number of triangles using each edge (1 for boundary edges).
+    edge_triangles : np.ndarray[E,2] (int32)
+      The (first two) triangles using each edge, -1 if none.
+    triangle_edges : np.ndarray[T,3] (int32)
+      Edge opposite each corner of each triangle.
+    neighbours : np.ndarray[T,3] (int32)
+      Triangle across the edge opposite each corner of each triangle,
+      -1 for boundary edges, like scipy.spatial.Delaunay.neighbors.
+    vertex_triangle_start, vertex_triangles : np.ndarray (int32)
+      The triangles using vertex v are
+      vertex_triangles[vertex_triangle_start[v]:vertex_triangle_start[v+1]].
+
+    Parameters
+    -----------
+    vertices : DataFrame
+      Vertices
+    triangles : DataFrame
+      Triangles with columns 0, 1, 2 with indices into vertices
+    """
+    def __init__(self, vertices, triangles, **kw):
+        self.fingerprint = topology_fingerprint(vertices, triangles)
+        n_vertices = len(vertices)
+        faces = vertices.index.get_indexer(triangles[[0, 1, 2]].values.ravel()).reshape((-1, 3))
+        if (faces < 0).any():
+            raise KeyError("Triangles reference vertices missing from the vertex index")
+        self.faces = faces.astype(np.int32)
+
+        # Half edge i of each triangle is opposite corner i
+        a = faces[:,[1, 2, 0]].ravel().astype(np.int64)
+        b = faces[:,[2, 0, 1]].ravel().astype(np.int64)
+        keys = np.minimum(a, b) * n_vertices + np.maximum(a, b)
+        order = np.argsort(keys, kind="stable")
+        keys = keys[order]
+        first = np.flatnonzero(np.diff(keys, prepend=-1) != 0)
+
+        self.edges = np.column_stack((keys[first] // max(n_vertices, 1),
+                                      keys[first] % max(n_vertices, 1))).astype(np.int32)
+        self.edge_counts = np.diff(np.append(first, len(keys))).astype(np.int32)
+        self.edge_triangles = np.full((len(first), 2), -1, dtype=np.int32)
+        self.edge_triangles[:,0] = order[first] // 3
+        shared = self.edge_counts > 1
+        self.edge_triangles[shared,1] = order[first[shared] + 1] // 3
+
+        triangle_edges = np.empty(len(keys), dtype=np.int32)
+        triangle_edges[order] = np.repeat(np.arange(len(first), dtype=np.int32), self.edge_counts)
+        self.triangle_edges = triangle_edges.reshape((-1, 3))
+
+        pairs = np.flatnonzero(keys[1:] == keys[:-1])
+        neighbours = np.full(len(keys), -1, dtype=np.int32)
+        neighbours[order[pairs]] = order[pairs + 1] // 3
+        neighbours[order[pairs + 1]] = order[pairs] // 3
+        self.neighbours = neighbours.reshape((-1, 3))
+
+        corners = faces.ravel()
+        self.vertex_triangles = (np.argsort(corners, kind="stable") // 3).astype(np.int32)
+        self.vertex_triangle_start = np.append(0, np.cumsum(np.bincount(corners, minlength=n_vertices))).astype(np.int32)
+
+    def is_valid(self, vertices, triangles):
+        "Check if this topology still matches vertices and triangles"
+        return self.fingerprint == topology_fingerprint(vertices, triangles)
+
+    @property
+    def boundary_edges(self):
+        "Positions into edges of the edges used by only one triangle"
+        return np.flatnonzero(self.edge_counts == 1)
+
+def get_topology(**tri):
+    """Return tri["topology"] if it is still valid for the
+    triangulation, otherwise build a new MeshTopology."""
+    topology = tri.get("topology", None)
+    if topology is None or not topology.is_valid(tri["vertices"], tri["triangles"]):
+        topology = MeshTopology(**tri)
+    return topology
+
+def mesh_topology(**tri):
+    """Build (or validate) the MeshTopology of a triangulation and
+    store it in tri["topology"], so that several operations on the
+    same mesh do not each rebuild its edges and adjacency."""
+    tri["topology"] = get_topology(**tri)
+    return tri
@@ -0,0 +1,241 @@
+import os
+import json
+import hashlib
+import collections
+import numpy as np
+import scipy.spatial
+import scipy.spatial.distance
+import scipy.optimize
+import skgstat
+import skgstat.models
+
+import logging
+logger = logging.getLogger(__name__)
+
+def _json_default(obj):
+    if hasattr(obj, "tolist"):
+        return obj.tolist()
+    return str(obj)
+
+def variogram_fingerprint(param_name, positions, values, variogram_args={}):
+    "Cache key for a variogram fitted to positions and values with variogram_args"
+    h = hashlib.sha1()
+    h.update(np.ascontiguousarray(positions, dtype=float).tobytes())
+    h.update(np.ascontiguousarray(values, dtype=float).tobytes())
+    h.update(json.dumps(variogram_args, sort_keys=True, default=_json_default).encode("utf-8"))
+    return "%s-%s" % (param_name, h.hexdigest())
+
+class VariogramCache(object):
+    """Cache of fitted variograms, keyed by parameter name plus a
+    fingerprint of the fitting data and variogram_args, so that
+    variograms are only fitted once for the same data, also across
+    processes and runs.
+
+    Fitted skgstat.Variogram objects (or descriptions loaded from disk)
+    are kept in memory, evicting the least recently used beyond
+    maxsize. If path is given, variogram descriptions (as returned by
+    Variogram.describe(), plus experimental and bins) are also stored
+    there as one small JSON file per variogram.
+
+    Parameters
+    -----------
+    path : str
+      Directory to persist variogram descriptions in, optional.
+    maxsize : int
+      Maximum number of variograms kept in memory.
+    """
+    def __init__(self, path=None, maxsize=128):
+        self.path = path
+        self.maxsize = maxsize
+        self.variograms = collections.OrderedDict()
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+
+    def _filename(self, key):
+        return os.path.join(self.path, key + ".json")
+
+    def get(self, key):
+        """Return the variogram (skgstat.Variogram or description dict)
+        for key, or None if not cached."""
+        if key in self.variograms:
+            self.variograms.move_to_end(key)
+            return self.variograms[key]
+        if self.path is not None and os.path.exists(self._filename(key)):
+            with open(self._filename(key)) as f:
+                variogram = json.load(f)
+            self._remember(key, variogram)
+            return variogram
+        return None
+
+    def set(self, key, variogram):
+        """Store a variogram (skgstat.Variogram or description dict)"""
+        self._remember(key, variogram)
+        if self.path is not None:
+            filename = self._filename(key)
+            with open(filename + ".tmp", "w") as f:
+                json.dump(variogram_description(variogram), f, default=_json_default)
+            os.replace(filename + ".tmp", filename)
+
+    def _remember(self, key, variogram):
+        self.variograms[key] = variogram
+        self.variograms.move_to_end(key)
+        while len(self.variograms) > self.maxsize:
+            self.variograms.popitem(last=False)
+
+def variogram_description(variogram):
+    """Description (dict) of a variogram, in the format stored in the
+    variogram column of variograms dataframes"""
+    if not isinstance(variogram, skgstat.Variogram):
+        return variogram
+    desc = variogram.describe()
+    desc["experimental"] = list(variogram.experimental)
+    desc["bins"] = list(variogram.bins)
+    return desc
+
+def subsample(positions, max_samples, sampling="random", seed=0):
+    """Reproducibly select at most max_samples of positions. Returns
+    sorted indices into positions.
+
+    sampling is either "random" (uniformly) or "stratified" (one
+    random position per cell of a grid of about max_samples cells,
+    topped up with random positions where cells are empty).
+    """
+    n = len(positions)
+    if n <= max_samples:
+        return np.arange(n)
+    rng = np.random.default_rng(seed)
+    if sampling == "random":
+        return np.sort(rng.choice(n, max_samples, replace=False))
+    elif sampling != "stratified":
+        raise NotImplementedError("Unknown sampling method %s..." % (sampling,))
+
+    lo = positions.min(axis=0)
+    extent = np.maximum(positions.max(axis=0) - lo, 1e-12)
+    cell_size = np.sqrt(extent[0] * extent[1] / max_samples)
+    cells = np.floor((positions - lo) / cell_size).astype(np.int64)
+    cells = cells[:,1] * (cells[:,0].max() + 1) + cells[:,0]
+    shuffled = rng.permutation(n)
+    selected = shuffled[np.unique(cells[shuffled], return_index=True)[1]]
+    if len(selected) > max_samples:
+        selected = rng.choice(selected, max_samples, replace=False)
+    elif len(selected) < max_samples:
+        rest = np.setdiff1d(np.arange(n), selected)
+        selected = np.append(selected, rng.choice(rest, max_samples - len(selected), replace=False))
+    return np.sort(selected)
+
+def _max_distance(positions):
+    "Maximum distance between any two of positions"
+    try:
+        # The furthest pair is always on the convex hull
+        positions = positions[scipy.spatial.ConvexHull(positions).vertices]
+    except scipy.spatial.QhullError:
+        # Collinear or too few positions
+        pass
+    if len(positions) < 2:
+        return 0.
+    return scipy.spatial.distance.pdist(positions).max()
+
+def estimate_variogram(positions, values, model="spherical", maxlag=0.5, n_lags=10, use_nugget=False, max_samples=5000, sampling="random", seed=0, **kw):
+    """Estimate a variogram for large numbers of positions without
+    computing all pairwise distances.
+
+    The data is reproducibly subsampled to max_samples positions, and
+    only pairs closer than maxlag are found, using a KD-tree, and
+    binned into n_lags even lags (Matheron estimator). The model is
+    then fitted to the experimental variogram with scipy curve_fit.
+
+    Parameters
+    -----------
+    positions : np.ndarray[N,2]
+    values : np.ndarray[N]
+    model : str
+      Name of a model in skgstat.models.
+    maxlag : float
+      Maximum lag distance. Values below 1 are taken as a fraction of
+      the maximum distance between any two positions, like
+      skgstat.Variogram does.
+    n_lags : int
+      Number of lag classes.
+    use_nugget : bool
+      Fit a nugget.
+    max_samples : int
+      Maximum number of positions to use.
+    sampling : str
+      "random" or "stratified", see subsample().
+    seed : int
+      Random seed for the subsampling.
+    **kw
+      skgstat.Variogram arguments for which only the behaviour above
+      is implemented (estimator="matheron", bin_func="even",
+      fit_method="trf", dist_func="euclidean", normalize=False) and
+      verbose. Other arguments or values raise an error.
+
+    Returns a variogram description, in the same format as stored in
+    variograms dataframes (and accepted by skgstat.OrdinaryKriging).
+    """
+    fixed = {"estimator": "matheron", "bin_func": "even", "fit_method": "trf",
+             "dist_func": "euclidean", "normalize": False}
+    for key, value in kw.items():
+        if key == "verbose":
+            continue
+        if key not in fixed:
+            raise TypeError("estimate_variogram() got an unexpected keyword argument %s" % (key,))
+        if value != fixed[key]:
+            raise NotImplementedError("Unsupported %s %s for kdtree variogram estimation..." % (key, value))
+
+    if maxlag < 1:
+        maxlag = maxlag * _max_distance(positions)
+
+    samples = subsample(positions, max_samples, sampling, seed)
+    positions = positions[samples]
+    values = values[samples]
+
+    pairs = scipy.spatial.cKDTree(positions).query_pairs(maxlag, output_type="ndarray")
+    dist = np.linalg.norm(positions[pairs[:,0]] - positions[pairs[:,1]], axis=1)
+    lag = np.minimum((dist / maxlag * n_lags).astype(int), n_lags - 1)
+    counts = np.bincount(lag, minlength=n_lags)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        experimental = 0.5 * np.bincount(
+            lag, (values[pairs[:,0]] - values[pairs[:,1]]) ** 2, minlength=n_lags) / counts
+    bins = maxlag / n_lags * np.arange(1, n_lags + 1)
+
+    valid = counts > 0
+    maxvar = np.nanmax(experimental)
+    model_function = getattr(skgstat.models, model.lower())
+    p0 = [maxlag, maxvar]
+    lower = [0, 0]
+    upper = [maxlag, maxvar]
+    if model.lower() == "stable":
+        p0.append(1.); lower.append(0.2); upper.append(2.)
+    elif model.lower() == "matern":
+        p0.append(1.); lower.append(0.2); upper.append(100.)
+    if use_nugget:
+        p0.append(0.); lower.append(0); upper.append(maxvar)
+    cof, cov = scipy.optimize.curve_fit(
+        lambda h, *cof: model_function(h, *cof),
+        bins[valid], experimental[valid], p0=p0, bounds=(lower, upper), method="trf")
+
+    desc = {
+        "model": model.lower(),
+        "estimator": "matheron",
+        "dist_func": "euclidean",
+        "normalized_effective_range": cof[0] * bins.max(),
+        "normalized_sill": cof[1] * maxvar,
+        "normalized_nugget": cof[-1] * maxvar if use_nugget else 0,
+        "effective_range": cof[0],
+        "sill": cof[1],
+        "nugget": cof[-1] if use_nugget else 0,
+    }
+    if model.lower() == "stable":
+        desc["shape"] = cof[2]
+    elif model.lower() == "matern":
+        desc["smoothness"] = cof[2]
+    desc["params"] = {
+        "estimator": "matheron", "model": model.lower(), "dist_func": "euclidean",
+        "bin_func": "even", "normalize": False, "fit_method": "trf", "fit_sigma": None,
+        "use_nugget": use_nugget, "maxlag": maxlag, "n_lags": n_lags, "verbose": False,
+        "estimation": "kdtree", "max_samples": max_samples, "sampling": sampling, "seed": seed}
+    desc["kwargs"] = {}
+    desc["experimental"] = list(experimental)
+    desc["bins"] = list(bins)
+    return desc